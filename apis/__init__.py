@@ -0,0 +1,58 @@
+import contextlib
+import random
+import time
+
+import utils.metrics
+import utils.tracing
+
+# Shared by the API modules
+API_DURATION = utils.metrics.Histogram("user_daemon_api_duration_seconds",
+    "Duration of remote API calls", ["api", "call"])
+SUBPROCESS_DURATION = utils.metrics.Histogram("user_daemon_subprocess_duration_seconds",
+    "Duration of external commands", ["command"])
+
+
+class MockFailure(Exception): pass
+
+
+class MockFaults(object):
+    """
+    Latency and failure injection for the API mocks, see benchmark.py.
+    Every mock call sleeps for `latency` seconds, batch calls only once,
+    and fails with probability `failure_rate`, per user for batch calls.
+    """
+    def __init__(self):
+        self.latency = 0.0
+        self.failure_rate = 0.0
+
+    def delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def fails(self):
+        return self.failure_rate > 0 and random.random() < self.failure_rate
+
+    def inject(self, call):
+        self.delay()
+        if self.fails():
+            raise MockFailure("Injected failure in %s" % call)
+
+
+mock_faults = MockFaults()
+
+
+@contextlib.contextmanager
+def timed_call(api, call, **args):
+    """
+    Time a remote API call, for metrics and the cycle trace.
+    """
+    with API_DURATION.time(api=api, call=call):
+        with utils.tracing.span("%s %s" % (api, call), api, **args):
+            yield
+
+
+@contextlib.contextmanager
+def timed_subprocess(command, **args):
+    with SUBPROCESS_DURATION.time(command=command):
+        with utils.tracing.span(command, "subprocess", **args):
+            yield
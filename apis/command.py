@@ -0,0 +1,130 @@
+"""
+Shared engine for running external commands (ssh, kinit, klist).
+
+Commands run under a global concurrency limit and optional per-command
+limits, with a deadline after which the process is killed. Output is read
+as it arrives, so large output can't block the child, and logged line by
+line.
+"""
+
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+
+import apis
+
+log = logging.getLogger("commandapi")
+
+
+class CommandResult(object):
+    def __init__(self, args, returncode, output, duration, timed_out=False):
+        self.args = args
+        self.returncode = returncode
+        self.output = output
+        self.duration = duration
+        self.timed_out = timed_out
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def __repr__(self):
+        return "<CommandResult %s ret=%s %.2fs%s>" % (os.path.basename(self.args[0]),
+            self.returncode, self.duration, self.timed_out and " timed out" or "")
+
+
+class CommandEngine(object):
+    """
+    Runs commands for all threads, at most `max_concurrent` at a time and
+    at most `limits[name]` of a given command, where name is the basename
+    of the executable.
+    """
+    def __init__(self, max_concurrent=8, limits=None):
+        self.configure(max_concurrent, limits)
+
+    def configure(self, max_concurrent, limits=None):
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.limits = dict((name, threading.BoundedSemaphore(limit))
+            for name, limit in (limits or {}).items())
+
+    def run(self, args, stdin=None, timeout=None, env=None, callback=None, name=None):
+        """
+        Run a command and return a CommandResult, output is stdout and
+        stderr combined. `callback` is called with each line of output as
+        it arrives. If the command runs for more than `timeout` seconds it
+        is killed and the result marked as timed out. `name` labels the
+        command in logs and metrics, defaults to the executable's name.
+        """
+        name = name or os.path.basename(args[0])
+        limit = self.limits.get(os.path.basename(args[0]))
+
+        with self.slots:
+            if limit is None:
+                return self._run(name, args, stdin, timeout, env, callback)
+            with limit:
+                return self._run(name, args, stdin, timeout, env, callback)
+
+    def _run(self, name, args, stdin, timeout, env, callback):
+        with apis.timed_subprocess(name):
+            start = time.time()
+            # Each command gets its own process group, so that whatever it
+            # started can be killed along with it.
+            p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, env=env, close_fds=True, preexec_fn=os.setsid)
+            log.debug("[%s %d] started: %s", name, p.pid, " ".join(args))
+
+            # Feed stdin and drain stdout on their own threads, so that
+            # neither side can fill a pipe and block the other.
+            writer = threading.Thread(target=self._write, args=(p, stdin), name="%s-stdin" % name)
+            writer.daemon = True
+            writer.start()
+
+            lines = []
+            reader = threading.Thread(target=self._read, args=(p, name, lines, callback),
+                name="%s-stdout" % name)
+            reader.daemon = True
+            reader.start()
+
+            reader.join(timeout)
+            timed_out = reader.is_alive()
+            if timed_out:
+                log.warning("[%s %d] still running after %s seconds, killing it", name, p.pid, timeout)
+                try:
+                    os.killpg(p.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                # The pipe closes once the process group is gone, unless
+                # something escaped it and still holds the pipe open.
+                reader.join(5)
+
+            returncode = p.wait()
+            duration = time.time() - start
+            log.debug("[%s %d] exited with %s after %.2f seconds", name, p.pid, returncode, duration)
+            return CommandResult(args, returncode, "".join(lines), duration, timed_out)
+
+    def _write(self, p, stdin):
+        try:
+            if stdin:
+                p.stdin.write(stdin)
+            p.stdin.close()
+        except IOError:
+            # The process exited without reading all of it
+            pass
+
+    def _read(self, p, name, lines, callback):
+        for line in iter(p.stdout.readline, ""):
+            lines.append(line)
+            log.debug("[%s %d] %s", name, p.pid, line.rstrip("\n"))
+            if callback is not None:
+                try:
+                    callback(line.rstrip("\n"))
+                except Exception:
+                    log.exception("Output callback for %s failed", name)
+        p.stdout.close()
+
+
+engine = CommandEngine()
+run = engine.run
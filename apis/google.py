@@ -5,10 +5,14 @@ import logging
 
 try:
     import stjornbord_google_api
+    from apiclient.http import BatchHttpRequest
     imported = True
 except ImportError:
     imported = False
 
+import apis
+import apis.recording
+
 log = logging.getLogger("googleapi")
 
 class GoogleException(Exception): pass
@@ -20,24 +24,180 @@ class GoogleException(Exception): pass
 
 def get_api(*args, **kwargs):
     """
-    API factory, returns mock if `debug` is set.
+    API factory, returns mock if `debug` is set. Calls are recorded or
+    replayed if set up in apis.recording.
     """
     if kwargs.pop("debug", True):
-        return GoogleMock()
+        return apis.recording.wrap("google", GoogleMock)
     else:
-        assert imported, "Failed importing gdata libraries"
-        return stjornbord_google_api.Google(*args, **kwargs)
+        def _factory():
+            assert imported, "Failed importing gdata libraries"
+            return stjornbord_google_api.Google(*args, **kwargs)
+        return apis.recording.wrap("google", _factory)
+
+
+def get_batch(client, domain, size=50):
+    """
+    Batch factory, returns a mock batch if `client` is a mock.
+    """
+    def _factory():
+        target = getattr(client, "_target", client)
+        if isinstance(target, GoogleMock):
+            return GoogleBatchMock(target, domain, size)
+        else:
+            return GoogleBatch(target, domain, size)
+    return apis.recording.wrap("google_batch", _factory)
+
+
+class GoogleBatch(object):
+    """
+    Groups Directory API user lookups and updates, and group membership
+    changes, into multipart batch requests of up to `size` calls. Relies
+    on the discovery based service object of the stjornbord_google_api
+    client.
+    """
+    def __init__(self, client, domain, size=50):
+        self.client = client
+        self.domain = domain
+        self.size = size
+
+    def _user_key(self, username):
+        return "%s@%s" % (username, self.domain)
+
+    def _execute(self, requests):
+        """
+        Execute a dict of request id, usually the username, to API request
+        in batches. Returns a tuple of dicts, request id to response and
+        request id to exception.
+        """
+        responses = {}
+        errors = {}
+
+        def _callback(request_id, response, exception):
+            if exception is not None:
+                errors[request_id] = exception
+            else:
+                responses[request_id] = response
+
+        usernames = list(requests)
+        for i in range(0, len(usernames), self.size):
+            batch = BatchHttpRequest(callback=_callback)
+            for username in usernames[i:i + self.size]:
+                batch.add(requests[username], request_id=username)
+            log.debug("Executing batch of %d requests", len(usernames[i:i + self.size]))
+            with apis.timed_call("google", "batch", requests=len(usernames[i:i + self.size])):
+                batch.execute()
+
+        return responses, errors
+
+    def users_get(self, usernames):
+        """
+        Returns a tuple of dicts, username to user (None if the user does
+        not exist) and username to exception for failed lookups.
+        """
+        users = self.client.service.users()
+        users, errors = self._execute(dict((username, users.get(userKey=self._user_key(username)))
+            for username in usernames))
+
+        for username, error in errors.items():
+            if getattr(getattr(error, "resp", None), "status", None) == 404:
+                users[username] = None
+                del errors[username]
 
+        return users, errors
 
-# Used for mocking user objects
-class Bunch(object):
-    def __init__(self, **kwargs):
-        self.__dict__.update(kwargs)
+    def users_mod(self, backend_users):
+        """
+        Update a dict of username to user resource. Returns a dict of
+        username to exception for the updates that failed.
+        """
+        users = self.client.service.users()
+        responses, errors = self._execute(dict((username, users.update(
+            userKey=self._user_key(username), body=backend_user))
+            for username, backend_user in backend_users.items()))
+        return errors
+
+
+    def iter_users(self, page_size=500):
+        """
+        Yield every user in the domain, fetched `page_size` at a time.
+        """
+        users = self.client.service.users()
+        request = users.list(domain=self.domain, maxResults=page_size,
+            fields="nextPageToken,users(primaryEmail,name,suspended)")
+        while request is not None:
+            with apis.timed_call("google", "list"):
+                response = request.execute()
+            for user in response.get("users", []):
+                yield user
+            request = users.list_next(request, response)
+
+
+    def groups_get(self, names):
+        """
+        Read the members of each group, one paged listing per group.
+        Returns a dict of group name to set of usernames, groups that don't
+        exist are left out. Only users in the domain are returned, other
+        members are never touched.
+        """
+        members_api = self.client.service.members()
+        suffix = "@" + self.domain.lower()
+        groups = {}
+        for name in names:
+            members = set()
+            request = members_api.list(groupKey=self._user_key(name), maxResults=200,
+                fields="nextPageToken,members(email,type)")
+            try:
+                while request is not None:
+                    with apis.timed_call("google", "members_list"):
+                        response = request.execute()
+                    for member in response.get("members", []):
+                        email = member.get("email", "").lower()
+                        if member.get("type") == "USER" and email.endswith(suffix):
+                            members.add(email[:-len(suffix)])
+                    request = members_api.list_next(request, response)
+            except Exception, e:
+                if getattr(getattr(e, "resp", None), "status", None) == 404:
+                    continue
+                raise
+            groups[name] = members
+        return groups
+
+    def groups_mod(self, changes):
+        """
+        Takes a dict of group name to a tuple of usernames to add and
+        usernames to remove, all sent as batched member inserts and
+        deletes. Returns a dict of group name to exception for the groups
+        where a change failed.
+        """
+        members_api = self.client.service.members()
+        requests = {}
+        calls = {}
+        for name, (add, remove) in changes.items():
+            for username in add:
+                request_id = "r%d" % len(requests)
+                calls[request_id] = (name, 409)
+                requests[request_id] = members_api.insert(groupKey=self._user_key(name),
+                    body={"email": self._user_key(username), "role": "MEMBER"})
+            for username in remove:
+                request_id = "r%d" % len(requests)
+                calls[request_id] = (name, 404)
+                requests[request_id] = members_api.delete(groupKey=self._user_key(name),
+                    memberKey=self._user_key(username))
+
+        responses, errors = self._execute(requests)
+        failed = {}
+        for request_id, error in errors.items():
+            name, done_status = calls[request_id]
+            # Already a member, or already gone
+            if getattr(getattr(error, "resp", None), "status", None) != done_status:
+                failed[name] = error
+        return failed
 
 
 class GoogleMock(object):
     def __init__(self):
-        pass
+        self.groups = {}
 
     def disconnect(self):
         log.info("GoogleMock: disconnect")
@@ -47,18 +207,24 @@ class GoogleMock(object):
         log.info("GoogleMock: user_add: username=%s, first_name=%s, last_name=%s "
             "password-hash=%d suspended=%s password_hash_function=%s", username, first_name,
             last_name, password, suspended, password_hash_function)
-        return self.user_get(username)
+        apis.mock_faults.inject("GoogleMock.user_add")
+        return self._user(username)
 
     def user_get(self, username):
         log.info("GoogleMock: user_get: username=%s", username)
-        return Bunch(
-            name=Bunch(given_name="Mock", family_name="Swift"),
-            login=Bunch(suspended="false", password="asdf", hash_function_name="SHA-1"),
-            )
+        apis.mock_faults.inject("GoogleMock.user_get")
+        return self._user(username)
+
+    def _user(self, username):
+        return {
+            "primaryEmail": "%s@mock.test" % username,
+            "name": {"givenName": "Mock", "familyName": "Swift"},
+            "suspended": False,
+            }
 
     def user_mod(self, username, backend_user):
         log.info("GoogleMock: user_mod: username=%s backend_user=%s", username, backend_user)
-        pass
+        apis.mock_faults.inject("GoogleMock.user_mod")
 
     def list_sync(self, name, members):
         log.info("GoogleMock: list_sync: name=%s members=%s", name, members)
@@ -67,3 +233,56 @@ class GoogleMock(object):
     def list_members(self, name):
         log.info("GoogleMock: list_members: name=%s", name)
         return ['fake.google.test.user%d' % i for i in range(3)]
+
+
+class GoogleBatchMock(object):
+    """
+    Batch counterpart of GoogleMock, issues the calls one by one against
+    the mock. Usernames listed in `fail` return errors, as do failures
+    injected through apis.mock_faults.
+    """
+    def __init__(self, client, domain, size=50):
+        self.client = client
+        self.size = size
+        self.fail = set()
+
+    def users_get(self, usernames):
+        log.info("GoogleBatchMock: users_get: usernames=%s", usernames)
+        apis.mock_faults.delay()
+        users, errors = {}, {}
+        for username in usernames:
+            if username in self.fail or apis.mock_faults.fails():
+                errors[username] = GoogleException("Mock failure for %s" % username)
+            else:
+                users[username] = self.client._user(username)
+        return users, errors
+
+    def iter_users(self, page_size=500):
+        log.info("GoogleBatchMock: iter_users")
+        apis.mock_faults.delay()
+        return iter([])
+
+    def groups_get(self, names):
+        log.info("GoogleBatchMock: groups_get: names=%s", names)
+        apis.mock_faults.delay()
+        return dict((name, set(self.client.groups.get(name, ()))) for name in names)
+
+    def groups_mod(self, changes):
+        log.info("GoogleBatchMock: groups_mod: names=%s", sorted(changes))
+        apis.mock_faults.delay()
+        errors = {}
+        for name, (add, remove) in changes.items():
+            if (add | remove) & self.fail or apis.mock_faults.fails():
+                errors[name] = GoogleException("Mock failure for group %s" % name)
+                continue
+            self.client.groups[name] = (self.client.groups.get(name, set()) | add) - remove
+        return errors
+
+    def users_mod(self, backend_users):
+        log.info("GoogleBatchMock: users_mod: usernames=%s", sorted(backend_users))
+        apis.mock_faults.delay()
+        errors = {}
+        for username, backend_user in backend_users.items():
+            if username in self.fail or apis.mock_faults.fails():
+                errors[username] = GoogleException("Mock failure for %s" % username)
+        return errors
@@ -1,19 +1,35 @@
+import datetime
 import logging
-import subprocess
+import re
+import threading
 import time
-import datetime
 
 try:
     from ipalib import api as ipa_api
     import ipalib.errors
+    import ldap
+    from ldap.controls import SimplePagedResultsControl
     imported = True
 except ImportError:
     imported = False
 
+import apis
+import apis.recording
+
 log = logging.getLogger("ipaapi")
 
 
-LDAPMOD     = ["ldapmodify", "-x", "-D", "cn=Directory Manager", "-w", ]
+LDAP_BIND_DN = "cn=Directory Manager"
+USERS_DN     = "cn=users,cn=accounts,dc=mr,dc=lan"
+USER_DN      = "uid=%s," + USERS_DN
+USER_UID     = re.compile(r"^uid=([^,]+),")
+GROUPS_DN    = "cn=groups,cn=accounts,dc=mr,dc=lan"
+
+# Attributes fetched when prefetching users
+USER_ATTRS = ["uid", "givenName", "sn", "cn", "displayName", "nsAccountLock"]
+
+# Number of users per LDAP search filter
+SEARCH_CHUNK_SIZE = 200
 
 
 class IpaException(Exception): pass
@@ -21,28 +37,48 @@ class IpaTicketExpired(IpaException): pass
 
 def get_api(*args, **kwargs):
     """
-    API factory, returns mock if `debug` is set.
+    API factory, returns mock if `debug` is set. Calls are recorded or
+    replayed if set up in apis.recording.
     """
     if kwargs.pop("debug", True):
-        return IpaMock()
+        return apis.recording.wrap("ipa", IpaMock)
     else:
-        assert imported, "Failed importing ipa libraries"
-        return Ipa(*args, **kwargs)
+        def _factory():
+            assert imported, "Failed importing ipa libraries"
+            return Ipa(*args, **kwargs)
+        return apis.recording.wrap("ipa", _factory)
 
 
 class Ipa(object):
-    def __init__(self, context, ldap_pass):
+    def __init__(self, context, ldap_pass, ldap_uri="ldap://localhost",
+            ldap_pool_size=2, confirm_timeout=30):
         ipa_api.bootstrap_with_global_options(context=context)
         ipa_api.finalize()
-        ipa_api.Backend.xmlclient.connect()
+        self._connect()
+
+        self.ldap = LdapPool(ldap_uri, LDAP_BIND_DN, ldap_pass, size=ldap_pool_size)
 
-        self.ldap_pass = ldap_pass
-        self.ldapmod = LDAPMOD + [ldap_pass, ]
+        # How long to wait for a password change to become visible, and
+        # statistics on how long it actually takes.
+        self.confirm_timeout = confirm_timeout
+        self.confirm_stats = {"count": 0, "total_sec": 0.0, "max_sec": 0.0, "timeouts": 0}
 
 
+    def _command(self, name, *args, **kwargs):
+        self._connect()
+        with apis.timed_call("ipa", name, args=[unicode(arg) for arg in args]):
+            return ipa_api.Command[name](*args, **kwargs)
+
+
+    def _connect(self):
+        # ipalib keeps the XML-RPC connection in thread local storage, so
+        # each worker thread has to connect before issuing commands.
+        if not ipa_api.Backend.xmlclient.isconnected():
+            ipa_api.Backend.xmlclient.connect()
+
     def user_get(self, username):
         try:
-            return ipa_api.Command.user_show(unicode(username))["result"]
+            return self._command("user_show", unicode(username))["result"]
         except ipalib.errors.TicketExpired:
             raise IpaTicketExpired()
         except ipalib.errors.NotFound:
@@ -51,6 +87,87 @@ class Ipa(object):
         return None
 
 
+    def users_get(self, usernames):
+        """
+        Look up many users with a few LDAP searches instead of one XML-RPC
+        call each. Only the attributes the backend needs are fetched, shaped
+        like the user_show result. Returns a dict of username to user, users
+        that don't exist are left out.
+        """
+        users = {}
+        usernames = list(usernames)
+        for i in range(0, len(usernames), SEARCH_CHUNK_SIZE):
+            filterstr = "(|%s)" % "".join("(uid=%s)" % _escape_filter(unicode(u))
+                for u in usernames[i:i + SEARCH_CHUNK_SIZE])
+            for dn, entry in self.ldap.search(USERS_DN, ldap.SCOPE_ONELEVEL, filterstr, USER_ATTRS):
+                user = _ldap_user(entry)
+                users[user["uid"][0]] = user
+        return users
+
+
+    def iter_users(self, page_size=500):
+        """
+        Yield (username, user) for every user, read with a paged LDAP
+        search. Users are shaped as in users_get.
+        """
+        for dn, entry in self.ldap.search_paged(USERS_DN, ldap.SCOPE_ONELEVEL,
+                "(uid=*)", USER_ATTRS, page_size):
+            user = _ldap_user(entry)
+            yield user["uid"][0], user
+
+
+    def groups_get(self, names):
+        """
+        Read the members of many groups with a few LDAP searches. Returns a
+        dict of group name to set of usernames, groups that don't exist are
+        left out. Nested groups are not members.
+        """
+        groups = {}
+        names = list(names)
+        for i in range(0, len(names), SEARCH_CHUNK_SIZE):
+            filterstr = "(|%s)" % "".join("(cn=%s)" % _escape_filter(unicode(name))
+                for name in names[i:i + SEARCH_CHUNK_SIZE])
+            for dn, entry in self.ldap.search(GROUPS_DN, ldap.SCOPE_ONELEVEL,
+                    filterstr, ["cn", "member"]):
+                members = set()
+                for member in entry.get("member", []):
+                    match = USER_UID.match(member)
+                    if match and member.lower().endswith(USERS_DN):
+                        members.add(match.group(1).decode("utf8"))
+                groups[entry["cn"][0].decode("utf8")] = members
+        return groups
+
+
+    def groups_mod(self, changes):
+        """
+        Takes a dict of group name to a tuple of usernames to add and
+        usernames to remove, applied with one command per group and
+        direction. Returns a dict of group name to error for the groups
+        that could not be fully changed.
+        """
+        errors = {}
+        for name, (add, remove) in changes.items():
+            for command, usernames in (("group_add_member", add), ("group_remove_member", remove)):
+                if not usernames:
+                    continue
+                try:
+                    result = self._command(command, unicode(name),
+                        user=[unicode(u) for u in sorted(usernames)])
+                except ipalib.errors.TicketExpired:
+                    raise IpaTicketExpired()
+                except ipalib.errors.PublicError, e:
+                    errors[name] = e
+                    break
+
+                # Members that are already in or missing from the group
+                # are reported as failed, along with users that don't exist.
+                failed = result.get("failed", {}).get("member", {}).get("user", [])
+                if failed:
+                    errors[name] = IpaException("%s failed for %s" % (command,
+                        ", ".join(u"%s (%s)" % (u, reason) for u, reason in failed)))
+        return errors
+
+
     def user_add(self, username, enabled=True, givenname=None, sn=None, cn=None, displayname=None,
             loginshell=u'/bin/bash', uidnumber=None, gidnumber=None):
 
@@ -61,7 +178,7 @@ class Ipa(object):
 
         fullname = self._format_fullname(givenname, sn)
         try:
-            return ipa_api.Command.user_add(
+            return self._command("user_add", 
                 unicode(username),
                 givenname=unicode(givenname),
                 sn=unicode(sn),
@@ -74,21 +191,34 @@ class Ipa(object):
             raise IpaTicketExpired()
 
 
-    def user_mod(self, username, backend_user, enabled=True,
+    def user_mod(self, username, backend_user, enabled=None,
             givenname=None, sn=None, displayname=None, cn=None):
-        fullname = self._format_fullname(givenname, sn)
-        try:
-            ipa_api.Command.user_mod(unicode(username),
-                givenname=unicode(givenname),
-                sn=unicode(sn),
-                displayname=fullname,
-                cn=fullname)["result"]
-        except ipalib.errors.TicketExpired:
-            raise IpaTicketExpired()
-        except ipalib.errors.EmptyModlist:
-            pass
-
-        self.update_status(username, backend_user, enabled)
+        """
+        Modify the given attributes, those left as None are not touched.
+        When a name changes, cn and displayname follow unless given.
+        """
+        options = {}
+        if givenname is not None:
+            options["givenname"] = unicode(givenname)
+        if sn is not None:
+            options["sn"] = unicode(sn)
+
+        if options:
+            fullname = self._format_fullname(
+                options.get("givenname", first_value(backend_user.get("givenname"))),
+                options.get("sn", first_value(backend_user.get("sn"))))
+            options["displayname"] = displayname or fullname
+            options["cn"] = cn or fullname
+
+            try:
+                self._command("user_mod", unicode(username), **options)["result"]
+            except ipalib.errors.TicketExpired:
+                raise IpaTicketExpired()
+            except ipalib.errors.EmptyModlist:
+                pass
+
+        if enabled is not None:
+            self.update_status(username, backend_user, enabled)
 
 
     def _format_fullname(self, first, last):
@@ -108,12 +238,15 @@ class Ipa(object):
             log.debug("User status is correct (currently_enabled == enabled == %s)", currently_enabled)
             return
 
-        if enabled:
-            log.info("Enabling user %s", username)
-            ipa_api.Command.user_enable(unicode(username))
-        else:
-            log.info("Disabling user %s", username)
-            ipa_api.Command.user_disable(unicode(username))
+        try:
+            if enabled:
+                log.info("Enabling user %s", username)
+                self._command("user_enable", unicode(username))
+            else:
+                log.info("Disabling user %s", username)
+                self._command("user_disable", unicode(username))
+        except ipalib.errors.TicketExpired:
+            raise IpaTicketExpired()
 
 
     def update_password(self, username, password):
@@ -128,61 +261,326 @@ class Ipa(object):
         if not password:
             return
 
-        username = unicode(username)
-        password = unicode(password)
-    
-        def _update_passwd(username, password):
-            log.info("Updating password for %s" % username)
-            p = subprocess.Popen(self.ldapmod, stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            p.stdin.write("dn: uid=%s,cn=users,cn=accounts,dc=mr,dc=lan\n" % username)
-            p.stdin.write("changetype:modify\n")
-            p.stdin.write("replace:userpassword\n")
-            p.stdin.write("userpassword:%s\n" % password)
-            p.stdin.close()
-            ret = p.wait()
-            log.info("ldapmodify output: %s" % p.stdout.read().strip())
-            return (ret == 0)
-    
-        def _update_exp(username):
-            log.info("Updating exp for %s" % username)
-            pw_exp = (datetime.datetime.now() + datetime.timedelta(days=365 * 9)).strftime("%Y%m%d")
-            p = subprocess.Popen(self.ldapmod, stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            p.stdin.write("dn: uid=%s,cn=users,cn=accounts,dc=mr,dc=lan\n" % username)
-            p.stdin.write("changetype:modify\n")
-            p.stdin.write("replace:krbpasswordexpiration\n")
-            p.stdin.write("krbpasswordexpiration:%s120000Z\n" % pw_exp)
-            p.stdin.close()
-            ret = p.wait()
-            log.info("ldapmodify output: %s" % p.stdout.read().strip())
-            return (ret == 0)
-    
+        if self.update_passwords({username: password}):
+            raise IpaException("Failed updating password for %s" % username)
+
+
+    def update_passwords(self, passwords):
+        """
+        Batched version of update_password, takes a dict of username to
+        password. All password writes are pipelined over a single LDAP
+        connection, followed by all expiry dates. Returns the set of
+        usernames that could not be updated.
+        """
+        passwords = dict((unicode(u), unicode(p)) for u, p in passwords.items() if p)
+        if not passwords:
+            return set()
+
         # The LDAP server is sometime slow, and there is race here where we can
         # update the expiry before the password change has been processed. So
-        # we use an advanced synchronization method called "sleeping".
-        SLEEP_TIME_SEC = 5
+        # we note the last password change time before writing, and wait for
+        # it to change before writing the expiry date.
+        before = self._last_password_changes(passwords)
+
+        log.info("Updating passwords for %d users", len(passwords))
+        failed = self._modify([self._password_mod(u, p) for u, p in passwords.items()])
+
+        done = [u for u in passwords if u not in failed]
+        if done:
+            unconfirmed = self._confirm_password_changes(done, before)
+            failed.update(unconfirmed)
+            done = [u for u in done if u not in unconfirmed]
+
+        if done:
+            log.info("Updating exp for %d users", len(done))
+            failed.update(self._modify([self._expiry_mod(u) for u in done]))
+
+        return failed
+
+
+    def _last_password_changes(self, usernames):
+        """
+        Returns a dict of username to krbLastPwdChange, users that have
+        never changed their password are left out.
+        """
+        changes = {}
+        usernames = list(usernames)
+        for i in range(0, len(usernames), SEARCH_CHUNK_SIZE):
+            filterstr = "(|%s)" % "".join("(uid=%s)" % _escape_filter(u)
+                for u in usernames[i:i + SEARCH_CHUNK_SIZE])
+            for dn, entry in self.ldap.search(USERS_DN, ldap.SCOPE_ONELEVEL,
+                    filterstr, ["uid", "krbLastPwdChange"]):
+                if "uid" in entry and "krblastpwdchange" in entry:
+                    changes[entry["uid"][0].decode("utf8")] = entry["krblastpwdchange"][0]
+        return changes
+
+
+    def _confirm_password_changes(self, usernames, before):
+        """
+        Poll until the password change is visible for each user, that is
+        until krbLastPwdChange differs from `before`. Returns the set of
+        usernames that were not confirmed within the deadline.
+        """
+        start = time.time()
+        deadline = start + self.confirm_timeout
+        delay = 0.05
+        pending = set(usernames)
+
+        while True:
+            current = self._last_password_changes(pending)
+            for username in list(pending):
+                if username in current and current[username] != before.get(username):
+                    pending.discard(username)
+
+            elapsed = time.time() - start
+            if not pending or time.time() + delay > deadline:
+                break
+
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+        stats = self.confirm_stats
+        stats["count"] += 1
+        stats["total_sec"] += elapsed
+        stats["max_sec"] = max(stats["max_sec"], elapsed)
+
+        if pending:
+            stats["timeouts"] += 1
+            log.warning("Password change not visible for %d users after %.3f seconds: %s",
+                len(pending), elapsed, ", ".join(sorted(pending)))
+        else:
+            log.info("Confirmed %d password changes in %.3f seconds (average %.3f, max %.3f)",
+                len(usernames), elapsed, stats["total_sec"] / stats["count"], stats["max_sec"])
+
+        return pending
+
+
+    def _password_mod(self, username, password):
+        return ((USER_DN % username).encode("utf8"),
+            [(ldap.MOD_REPLACE, "userPassword", password.encode("utf8"))])
+
+
+    def _expiry_mod(self, username):
+        pw_exp = (datetime.datetime.now() + datetime.timedelta(days=365 * 9)).strftime("%Y%m%d")
+        return ((USER_DN % username).encode("utf8"),
+            [(ldap.MOD_REPLACE, "krbPasswordExpiration", "%s120000Z" % pw_exp)])
+
+
+    def _modify(self, changes):
+        """
+        Apply a list of (dn, modlist) changes, returns the set of usernames
+        whose modification failed.
+        """
+        failed = set()
+        for dn, error in self.ldap.modify(changes).items():
+            log.warning("Failed to modify %s: %s", dn, error)
+            failed.add(USER_UID.match(dn).group(1).decode("utf8"))
+        return failed
+
+
+def first_value(value):
+    # user_show returns most attributes as lists of values
+    if isinstance(value, (list, tuple)):
+        return value[0] if value else None
+    return value
+
+
+def _ldap_user(entry):
+    user = dict((attr, [v.decode("utf8") for v in values])
+        for attr, values in entry.items())
+    user["nsaccountlock"] = entry.get("nsaccountlock", ["FALSE"])[0].upper() == "TRUE"
+    return user
+
+
+def _escape_filter(value):
+    # RFC 4515 escaping of assertion values
+    for char in "\\*()\x00":
+        value = value.replace(char, "\\%02x" % ord(char))
+    return value
+
+
+class LdapPool(object):
+    """
+    A small pool of bound LDAP connections. Connections are created lazily,
+    handed out to one thread at a time and dropped if the server goes away.
+    """
+    def __init__(self, uri, bind_dn, password, size=2, timeout=10):
+        self.uri = uri
+        self.bind_dn = bind_dn
+        self.password = password
+        self.timeout = timeout
+
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+
+    def _connect(self):
+        log.debug("Opening LDAP connection to %s", self.uri)
+        conn = ldap.initialize(self.uri)
+        conn.protocol_version = ldap.VERSION3
+        conn.set_option(ldap.OPT_NETWORK_TIMEOUT, self.timeout)
+        conn.set_option(ldap.OPT_TIMEOUT, self.timeout)
+        conn.simple_bind_s(self.bind_dn, self.password)
+        return conn
+
+
+    def _call(self, name, func):
+        """
+        Run func with a pooled connection. If the connection turns out to be
+        dead it is discarded and func is retried once on a fresh one.
+        """
+        with self.slots:
+            for attempt in (1, 2):
+                with self.lock:
+                    conn = self.idle.pop() if self.idle else None
+
+                try:
+                    if conn is None:
+                        conn = self._connect()
+                    with apis.timed_call("ldap", name):
+                        result = func(conn)
+                except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT), e:
+                    log.warning("LDAP connection to %s failed (attempt %d): %s", self.uri, attempt, e)
+                    if conn is not None:
+                        try:
+                            conn.unbind_s()
+                        except ldap.LDAPError:
+                            pass
+                    if attempt == 2:
+                        raise IpaException("LDAP connection to %s failed: %s" % (self.uri, e))
+                    continue
+
+                with self.lock:
+                    self.idle.append(conn)
+                return result
+
+
+    def modify(self, changes):
+        """
+        Pipeline a list of (dn, modlist) modifications over one connection.
+        Returns a dict of dn to error for the modifications that failed.
+        """
+        def _modify(conn):
+            msgids = [(dn, conn.modify(dn, modlist)) for dn, modlist in changes]
+            errors = {}
+            for dn, msgid in msgids:
+                try:
+                    conn.result(msgid)
+                except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT):
+                    raise
+                except ldap.LDAPError, e:
+                    errors[dn] = e
+            return errors
+
+        return self._call("modify", _modify)
+
+
+    def search(self, base, scope, filterstr, attrs=None):
+        """
+        Returns a list of (dn, entry) tuples, attribute names in the entries
+        are lowercased.
+        """
+        def _search(conn):
+            return conn.search_s(base, scope, filterstr.encode("utf8"), attrs)
+
+        return [(dn, dict((k.lower(), v) for k, v in entry.items()))
+            for dn, entry in self._call("search", _search)]
+
+
+    def search_paged(self, base, scope, filterstr, attrs=None, page_size=500):
+        """
+        Yield (dn, entry) tuples like search, fetching `page_size` entries
+        at a time with the simple paged results control. The connection
+        is held until the results have been consumed.
+        """
+        with self.slots:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+
+            healthy = False
+            try:
+                if conn is None:
+                    conn = self._connect()
+
+                control = SimplePagedResultsControl(True, size=page_size, cookie="")
+                while True:
+                    with apis.timed_call("ldap", "search_paged"):
+                        msgid = conn.search_ext(base, scope, filterstr.encode("utf8"), attrs,
+                            serverctrls=[control])
+                        rtype, rdata, rmsgid, controls = conn.result3(msgid)
+
+                    for dn, entry in rdata:
+                        yield dn, dict((k.lower(), v) for k, v in entry.items())
+
+                    cookies = [c.cookie for c in controls
+                        if c.controlType == SimplePagedResultsControl.controlType]
+                    if not cookies or not cookies[0]:
+                        break
+                    control.cookie = cookies[0]
+                healthy = True
+            finally:
+                if healthy:
+                    with self.lock:
+                        self.idle.append(conn)
+                elif conn is not None:
+                    # Abandoned halfway or failed, the connection may be in
+                    # the middle of a paged search.
+                    try:
+                        conn.unbind_s()
+                    except ldap.LDAPError:
+                        pass
 
-        _update_passwd(username, password)
-        log.info("Sleeping for %d seconds ...", SLEEP_TIME_SEC)
-        time.sleep(SLEEP_TIME_SEC)
-        _update_exp(username)
-        
 
 class IpaMock(object):
     def __init__(self):
-        pass
+        self.groups = {}
 
     def user_get(self, username):
         log.info("IpaMock: user_get: username=%s", username)
+        apis.mock_faults.inject("IpaMock.user_get")
         return {"username": username}
 
+    def users_get(self, usernames):
+        log.info("IpaMock: users_get: usernames=%s", usernames)
+        apis.mock_faults.inject("IpaMock.users_get")
+        return dict((username, {"username": username}) for username in usernames)
+
     def user_add(self, username, **kwargs):
         log.info("IpaMock: user_add: username=%s kwargs=%s", username, kwargs)
+        apis.mock_faults.inject("IpaMock.user_add")
 
     def user_mod(self, username, backend_user, **kwargs):
         log.info("IpaMock: user_mod: username=%s kwargs=%s", username, kwargs)
+        apis.mock_faults.inject("IpaMock.user_mod")
+
+    def iter_users(self, page_size=500):
+        log.info("IpaMock: iter_users")
+        apis.mock_faults.delay()
+        return iter([])
+
+    def groups_get(self, names):
+        log.info("IpaMock: groups_get: names=%s", names)
+        apis.mock_faults.delay()
+        return dict((name, set(self.groups.get(name, ()))) for name in names)
+
+    def groups_mod(self, changes):
+        log.info("IpaMock: groups_mod: names=%s", sorted(changes))
+        apis.mock_faults.delay()
+        errors = {}
+        for name, (add, remove) in changes.items():
+            if apis.mock_faults.fails():
+                errors[name] = apis.MockFailure("Injected failure in IpaMock.groups_mod")
+                continue
+            self.groups[name] = (self.groups.get(name, set()) | add) - remove
+        return errors
 
     def update_password(self, username, password):
         log.info("IpaMock: update_password: username=%s password-len=%s",
             username, len(password))
+        apis.mock_faults.inject("IpaMock.update_password")
+
+    def update_passwords(self, passwords):
+        log.info("IpaMock: update_passwords: usernames=%s", sorted(passwords))
+        apis.mock_faults.delay()
+        return set(username for username in passwords if apis.mock_faults.fails())
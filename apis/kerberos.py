@@ -0,0 +1,140 @@
+import logging
+import os
+import re
+import threading
+import time
+
+import apis.command
+import apis.recording
+
+log = logging.getLogger("kerberosapi")
+
+# MIT klist output, e.g.
+#   10/18/2026 10:00:00  10/19/2026 10:00:00  krbtgt/MR.LAN@MR.LAN
+#           renew until 04/01/2027 10:00:00
+DATE = r"(\d\d/\d\d/\d{2,4} \d\d:\d\d:\d\d)"
+TGT_RE   = re.compile(DATE + r"\s+" + DATE + r"\s+krbtgt/")
+RENEW_RE = re.compile(r"renew until " + DATE)
+
+# kinit may have to reach the KDC, klist only reads the ticket cache
+KINIT_TIMEOUT_SEC = 30
+KLIST_TIMEOUT_SEC = 10
+
+
+def _parse_date(value):
+    for fmt in ("%m/%d/%Y %H:%M:%S", "%m/%d/%y %H:%M:%S"):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise ValueError("Unknown klist date format: %s" % value)
+
+
+def read_ticket_cache():
+    """
+    Returns a tuple of the ticket granting ticket's expiry and renew-till
+    times, as timestamps. Both are None if there is no usable ticket.
+    """
+    result = apis.command.run(["klist"], env=dict(os.environ, LC_ALL="C"), timeout=KLIST_TIMEOUT_SEC)
+    if not result.ok:
+        log.debug("klist ret=%s, output: %s", result.returncode, result.output.strip())
+        return None, None
+
+    lines = result.output.splitlines()
+    for i, line in enumerate(lines):
+        match = TGT_RE.search(line)
+        if match is None:
+            continue
+
+        expires = _parse_date(match.group(2))
+        renew_until = None
+        if i + 1 < len(lines):
+            renew = RENEW_RE.search(lines[i + 1])
+            if renew is not None:
+                renew_until = _parse_date(renew.group(1))
+        return expires, renew_until
+
+    return None, None
+
+
+def renew_ticket():
+    """
+    Renew the ticket granting ticket, returns a tuple of kinit's exit code
+    and output.
+    """
+    result = apis.command.run(["kinit", "-R"], timeout=KINIT_TIMEOUT_SEC)
+    if result.timed_out:
+        return result.returncode, "kinit timed out after %d seconds" % KINIT_TIMEOUT_SEC
+    return result.returncode, result.output
+
+
+class TicketCache(object):
+    """
+    The ticket cache operations CredentialManager relies on, as an object
+    so they can be recorded and replayed, see apis.recording.
+    """
+    def read(self):
+        return read_ticket_cache()
+
+    def renew(self):
+        return renew_ticket()
+
+
+class CredentialManager(threading.Thread):
+    """
+    Background thread that watches the Kerberos ticket cache and renews
+    the ticket `renew_before` seconds ahead of its expiry, for as long as
+    the ticket is renewable.
+    """
+    def __init__(self, renew_before=4 * 3600, check_interval=300):
+        threading.Thread.__init__(self, name="kerberos")
+        self.daemon = True
+        self.renew_before = renew_before
+        self.check_interval = check_interval
+
+        self.cache = apis.recording.wrap("kerberos", TicketCache)
+        self.expires = None
+        self.renew_until = None
+        self.refresh()
+
+    def valid_until(self):
+        """
+        When the current ticket expires, None if there is none. Cheap, the
+        ticket cache is read by the background thread.
+        """
+        return self.expires
+
+    def usable(self):
+        return self.expires is not None and self.expires > time.time()
+
+    def refresh(self):
+        self.expires, self.renew_until = self.cache.read()
+        now = time.time()
+
+        if self.expires is None:
+            log.warning("No Kerberos ticket found")
+            return
+
+        if self.expires - now > self.renew_before:
+            return
+
+        if self.renew_until is None or self.renew_until <= now:
+            log.warning("Kerberos ticket expires at %s and can't be renewed",
+                time.ctime(self.expires))
+            return
+
+        ret, output = self.cache.renew()
+        log.debug("   kinit renew ret=%s, output: %s", ret, output.strip())
+
+        self.expires, self.renew_until = self.cache.read()
+        if self.expires is not None:
+            log.info("Kerberos ticket valid until %s, renewable until %s",
+                time.ctime(self.expires), self.renew_until and time.ctime(self.renew_until))
+
+    def run(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                self.refresh()
+            except Exception:
+                log.exception("Could not refresh Kerberos credentials")
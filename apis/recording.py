@@ -0,0 +1,242 @@
+"""
+Record and replay API traffic.
+
+In recording mode the real API objects are wrapped so that every call's
+arguments, result and duration is appended to a file as a line of JSON,
+with passwords redacted. In replay mode no real API is touched, calls are
+answered from a recording with the recorded latency, so production shaped
+workloads can be run and profiled anywhere. See configure().
+"""
+
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import types
+
+log = logging.getLogger("user_daemon.recording")
+
+REDACTED = "<redacted>"
+
+# Keys whose values are redacted wherever they appear, lower case
+SECRET_KEYS = set(["password", "userpassword", "tmppass", "krbprincipalkey", "ldap_pass"])
+
+# Positional arguments holding secrets, by api and call
+SECRET_ARGS = {
+    ("ipa", "update_password"): (1, ),
+    ("google", "user_add"): (3, ),
+}
+
+# Calls taking a dict of username to secret
+SECRET_VALUES = set([("ipa", "update_passwords")])
+
+recorder = None
+replayer = None
+
+
+class ReplayedError(Exception): pass
+class NoRecording(Exception): pass
+
+
+def configure(record=None, replay=None):
+    """
+    Record API calls to the file `record`, or replay them from the file
+    `replay`. Must be called before the APIs are created.
+    """
+    global recorder, replayer
+    if record and replay:
+        raise ValueError("Can't record and replay at the same time")
+    recorder = record and Recorder(record) or None
+    replayer = replay and Replayer(replay) or None
+
+
+def wrap(api, factory):
+    """
+    Returns the API object `factory` creates, wrapped for recording, or a
+    stand-in answering from the recording when replaying.
+    """
+    if replayer is not None:
+        return ReplayProxy(replayer, api)
+    target = factory()
+    if recorder is not None:
+        return RecordingProxy(target, recorder, api)
+    return target
+
+
+def sanitize(value):
+    """
+    Make `value` JSON serializable, redacting secrets. Exceptions and sets
+    are tagged so they can be restored on replay.
+    """
+    if isinstance(value, dict):
+        return dict((key, REDACTED if str(key).lower() in SECRET_KEYS else sanitize(item))
+            for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [sanitize(item) for item in value]
+    if isinstance(value, (set, frozenset)):
+        return {"__set__": sorted(sanitize(item) for item in value)}
+    if isinstance(value, BaseException):
+        return {"__error__": "%s.%s" % (value.__class__.__module__, value.__class__.__name__),
+            "message": unicode(value)}
+    if value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return value
+    if callable(value):
+        # e.g. progress callbacks, which aren't called on replay
+        return "<callable>"
+    return unicode(value)
+
+
+def restore(value):
+    if isinstance(value, dict):
+        if "__set__" in value:
+            return set(restore(item) for item in value["__set__"])
+        if "__error__" in value:
+            return _error(value["__error__"], value["message"])
+        return dict((key, restore(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [restore(item) for item in value]
+    return value
+
+
+def _error(name, message):
+    """
+    Recreate a recorded exception if its class is loaded, so callers can
+    tell errors apart as they did when recording.
+    """
+    module, _, classname = name.rpartition(".")
+    klass = getattr(sys.modules.get(module), classname, None)
+    if isinstance(klass, type) and issubclass(klass, Exception):
+        try:
+            return klass(message)
+        except Exception:
+            pass
+    return ReplayedError("%s: %s" % (name, message))
+
+
+def _call_args(api, call, args, kwargs):
+    args = list(args)
+    for i in SECRET_ARGS.get((api, call), ()):
+        if i < len(args):
+            args[i] = REDACTED
+    if (api, call) in SECRET_VALUES and args and isinstance(args[0], dict):
+        args[0] = dict((key, REDACTED) for key in args[0])
+    return sanitize(args), sanitize(kwargs)
+
+
+def _key(args, kwargs):
+    return json.dumps([args, kwargs], sort_keys=True)
+
+
+class Recorder(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.fp = open(filename, "a")
+        self.lock = threading.Lock()
+        log.info("Recording API calls to %s", filename)
+
+    def record(self, api, call, args, kwargs, duration, result=None, error=None):
+        args, kwargs = _call_args(api, call, args, kwargs)
+        entry = {"api": api, "call": call, "args": args, "kwargs": kwargs,
+            "duration": round(duration, 6)}
+        if error is not None:
+            entry["error"] = sanitize(error)
+        else:
+            entry["result"] = sanitize(result)
+
+        line = json.dumps(entry)
+        with self.lock:
+            self.fp.write(line + "\n")
+            self.fp.flush()
+
+
+class RecordingProxy(object):
+    """
+    Passes calls through to `target`, recording the public methods.
+    """
+    def __init__(self, target, recorder, api):
+        self._target = target
+        self._recorder = recorder
+        self._api = api
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        def _call(*args, **kwargs):
+            start = time.time()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception, e:
+                self._recorder.record(self._api, name, args, kwargs, time.time() - start, error=e)
+                raise
+            if isinstance(result, types.GeneratorType):
+                # Streams, e.g. full listings, are too big to record
+                return result
+            self._recorder.record(self._api, name, args, kwargs, time.time() - start, result=result)
+            return result
+        return _call
+
+
+class Replayer(object):
+    """
+    Answers calls from a recording. A call with the same arguments as a
+    recorded one gets its result and latency. Other calls get the results
+    of recorded calls by the same name in turn, with a latency drawn from
+    the recorded ones.
+    """
+    def __init__(self, filename):
+        self.exact = {}
+        self.by_call = {}
+        self.turn = {}
+        self.lock = threading.Lock()
+
+        count = 0
+        for line in open(filename):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            call = (entry["api"], entry["call"])
+            self.exact.setdefault((call, _key(entry["args"], entry["kwargs"])), []).append(entry)
+            self.by_call.setdefault(call, []).append(entry)
+            count += 1
+        log.info("Replaying %d API calls from %s", count, filename)
+
+    def _entry(self, api, call, args, kwargs):
+        args, kwargs = _call_args(api, call, args, kwargs)
+        with self.lock:
+            entries = self.exact.get(((api, call), _key(args, kwargs)))
+            if entries:
+                # Repeat the last matching call once they've all been used
+                entry = len(entries) > 1 and entries.pop(0) or entries[0]
+                return entry, entry["duration"]
+
+            entries = self.by_call.get((api, call))
+            if not entries:
+                raise NoRecording("No recorded %s.%s calls" % (api, call))
+            i = self.turn.get((api, call), 0)
+            self.turn[(api, call)] = i + 1
+            return entries[i % len(entries)], random.choice(entries)["duration"]
+
+    def replay(self, api, call, args, kwargs):
+        entry, duration = self._entry(api, call, args, kwargs)
+        time.sleep(duration)
+        if "error" in entry:
+            raise restore(entry["error"])
+        return restore(entry["result"])
+
+
+class ReplayProxy(object):
+    def __init__(self, replayer, api):
+        self._replayer = replayer
+        self._api = api
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def _call(*args, **kwargs):
+            return self._replayer.replay(self._api, name, args, kwargs)
+        return _call
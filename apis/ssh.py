@@ -0,0 +1,100 @@
+import logging
+import pipes
+
+import apis.command
+
+log = logging.getLogger("sshapi")
+
+# ssh exits with this code when the connection itself fails
+SSH_ERROR = 255
+
+
+class SshException(Exception): pass
+
+
+class SshTransport(object):
+    """
+    Runs commands on a remote host over a shared SSH control connection
+    (ControlMaster), so that only the first command pays for the handshake
+    and authentication. The master stays up for `persist` seconds after the
+    last command. Commands running for longer than `timeout` seconds are
+    killed.
+    """
+    def __init__(self, host, control_path, persist=600, connect_timeout=10, timeout=None):
+        self.host = host
+        self.timeout = timeout
+        self.options = [
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPath=%s" % control_path,
+            "-o", "ControlPersist=%d" % persist,
+            "-o", "ConnectTimeout=%d" % connect_timeout,
+            "-o", "BatchMode=yes",
+        ]
+
+    def _ssh(self, args, stdin=None, callback=None, timeout=None):
+        result = apis.command.run(["ssh"] + self.options + [self.host] + args,
+            stdin=stdin, callback=callback, timeout=timeout or self.timeout)
+        if result.timed_out:
+            raise SshException("%s on %s timed out after %.0f seconds" % (
+                " ".join(args[:1]), self.host, result.duration))
+        return result.returncode, result.output
+
+    def _control(self, command):
+        result = apis.command.run(["ssh"] + self.options + ["-O", command, self.host],
+            timeout=30, name="ssh -O")
+        log.debug("ssh -O %s ret=%s, output: %s", command, result.returncode, result.output.strip())
+        return result.ok
+
+    def reset(self):
+        """
+        Tear down the control connection, the next command opens a new one.
+        """
+        log.info("Resetting SSH control connection to %s", self.host)
+        self._control("exit")
+
+    def run(self, args, stdin=None, callback=None, timeout=None):
+        """
+        Run a remote command, returns a tuple of exit code and output. If
+        `callback` is given it is called with each line of output as it
+        arrives. If the connection fails, e.g. because the master died while
+        idle, it is reset and the command retried once. Raises SshException
+        if the command runs for longer than `timeout` seconds, by default
+        the transport's timeout.
+        """
+        args = [pipes.quote(arg) for arg in args]
+        ret, output = self._ssh(args, stdin, callback, timeout)
+        if ret == SSH_ERROR:
+            log.warning("SSH connection to %s failed: %s", self.host, output.strip())
+            self.reset()
+            ret, output = self._ssh(args, stdin, callback, timeout)
+            if ret == SSH_ERROR:
+                raise SshException("SSH connection to %s failed: %s" % (self.host, output.strip()))
+        return ret, output
+
+    def run_many(self, script, args):
+        """
+        Run `script` once for each of `args` in a single remote shell.
+        Returns a dict of arg to a tuple of exit code and output. Arguments
+        that have no result, e.g. because the connection died, are left out.
+        """
+        runner = (
+            'for arg in "$@"; do\n'
+            '  out=$(%s "$arg" 2>&1)\n'
+            '  echo "RESULT $? $arg"\n'
+            '  printf "%%s\\n" "$out" | sed "s/^/ /"\n'
+            'done\n' % pipes.quote(script))
+
+        ret, output = self.run(["sh", "-s", "--"] + list(args), stdin=runner)
+
+        results = {}
+        current = None
+        for line in output.splitlines():
+            if line.startswith("RESULT "):
+                code, arg = line[7:].split(" ", 1)
+                current = arg
+                results[arg] = (int(code), [])
+            elif line.startswith(" ") and current is not None:
+                results[current][1].append(line[1:])
+
+        return dict((arg, (code, "\n".join(lines).strip()))
+            for arg, (code, lines) in results.items())
@@ -1,13 +1,55 @@
+import contextlib
+import hashlib
+import json
 import logging
 
 import settings
+import utils.metrics
+import utils.tracing
 
 log = logging.getLogger("user_daemon")
 
-class NonRetryableException(Exception): pass
+# Stands in for a user that a bulk lookup found not to exist
+MISSING = object()
+
+BACKEND_DURATION = utils.metrics.Histogram("user_daemon_backend_duration_seconds",
+    "Time spent in backends by operation", ["backend", "operation"])
+
+
+@contextlib.contextmanager
+def timed(backend, operation, **args):
+    """
+    Time a backend operation, for metrics and the cycle trace.
+    """
+    with BACKEND_DURATION.time(backend=str(backend), operation=operation):
+        with utils.tracing.span("%s %s" % (backend, operation), "backend", **args):
+            yield
+
+class NonRetryableException(Exception):
+    """
+    Processing can't continue until something outside the daemon is fixed.
+    The main loop sleeps for `retry_after` seconds (default
+    settings.NON_RETRYABLE_ERROR_SLEEP_SEC), and only mails the admins
+    if `notify` is set.
+    """
+    def __init__(self, message, retry_after=None, notify=True):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+        self.notify = notify
 
 
 class Backend(object):
+    # User fields whose values the backend acts on, None for all but the
+    # dirty timestamp. Used to fingerprint what was last applied.
+    FINGERPRINT_FIELDS = None
+
+    # Shadow state store, see utils.state.ShadowStore. Set up by main.
+    shadow = None
+
+    # Whether full reconciliation compares the backend's user store with
+    # Stjornbord, see reconcile_state and iter_backend_state.
+    RECONCILE = False
+
     def tick(self):
         """
         Invoked every cycle by the main loop, whether there are any
@@ -15,6 +57,13 @@ class Backend(object):
         """
         pass
 
+    def prefetch(self, users):
+        """
+        Invoked with a batch of dirty users before any of them are processed,
+        gives backends a chance to load state for the whole batch in bulk.
+        """
+        pass
+
     def process_user(self, user):
         """
         Invoked for each dirty user. Implementations should be idempotent and
@@ -24,11 +73,81 @@ class Backend(object):
         """
         raise NotImplementedError
 
+    def flush(self):
+        """
+        Invoked after a batch of users has been through process_user. Backends
+        that defer work to be done in bulk should do it here and return the
+        set of usernames whose deferred work failed, they remain dirty.
+        """
+        return set()
+
+    def discard(self):
+        """
+        Invoked instead of flush when a batch is aborted. Backends that defer
+        work drop it, the users stay dirty and are processed again.
+        """
+        pass
+
+    def reconcile_state(self, user):
+        """
+        The state the backend should have for `user`, as a tuple of a JSON
+        serializable value comparable with what iter_backend_state yields,
+        and whether the user must exist in the backend. None if the backend
+        has no opinion on the user.
+        """
+        return None
+
+    def iter_backend_state(self):
+        """
+        Yield (username, state) for every user in the backend store, read
+        in bulk.
+        """
+        raise NotImplementedError()
+
+    def sync_groups(self, groups):
+        """
+        Invoked every cycle with a dict of group name to set of usernames
+        that should be members, when group sync is enabled. Backends that
+        manage groups bring them in line, see utils.groups.GroupSync.
+        """
+        pass
+
+    def fingerprint(self, user):
+        fields = self.FINGERPRINT_FIELDS
+        if fields is None:
+            fields = [field for field in user if field != "dirty"]
+        data = json.dumps([(field, user.get(field)) for field in sorted(fields)])
+        return hashlib.sha1(data).hexdigest()
+
+    def is_unchanged(self, user):
+        """
+        True if this exact user data was successfully applied by the backend
+        less than settings.SHADOW_TTL_SEC ago, in which case there is no need
+        to talk to the backend store.
+        """
+        if self.shadow is None:
+            return False
+        return self.shadow.matches(str(self), user["username"], self.fingerprint(user),
+            settings.SHADOW_TTL_SEC)
+
+    def record_applied(self, users):
+        """
+        Invoked with the users the whole backend chain successfully processed.
+        """
+        if self.shadow is not None and users:
+            self.shadow.record(str(self),
+                [(user["username"], self.fingerprint(user)) for user in users])
+
     def __str__(self):
         return self.__class__.__name__
 
 
 class UserBackend(Backend):
+    FINGERPRINT_FIELDS = ["username", "status", "first_name", "last_name", "tmppass", "posix_uid"]
+
+    # Backend users loaded by prefetch, consumed by process_user
+    prefetched = {}
+
     def fetch_backend_user(self, username):
         """
         Fetch user object from backend store, None if non-existent. The
@@ -37,6 +156,22 @@ class UserBackend(Backend):
         """
         raise NotImplementedError()
 
+    def fetch_backend_users(self, usernames):
+        """
+        Bulk version of fetch_backend_user, returns a dict of username to
+        backend user, or MISSING for users known not to exist. Users left
+        out of the dict are looked up individually with fetch_backend_user.
+        """
+        return {}
+
+    def prefetch(self, users):
+        self.prefetched = {}
+        users = [user for user in users if not self.is_unchanged(user)]
+        self.prefetched = self.fetch_backend_users([user["username"] for user in users])
+        missing = len([u for u in self.prefetched.values() if u is MISSING])
+        log.info("Prefetched %d of %d users in backend %s, %d of them don't exist",
+            len(self.prefetched), len(users), self.__class__.__name__, missing)
+
     def user_add(self, user):
         raise NotImplementedError()
 
@@ -49,17 +184,27 @@ class UserBackend(Backend):
     def process_user(self, user):
         username = user["username"]
 
+        if self.is_unchanged(user):
+            log.info("User %s unchanged since last applied in backend %s, skipping",
+                username, self.__class__.__name__)
+            return
+
         log.info("Processing user %s in backend %s", username, self.__class__.__name__)
 
-        # Fetch user_info
-        backend_user = self.fetch_backend_user(user["username"])
+        # Fetch user_info, preferably from the prefetched batch
+        backend_user = self.prefetched.pop(username, None)
+        if backend_user is MISSING:
+            backend_user = None
+        elif backend_user is None:
+            backend_user = self.fetch_backend_user(username)
         
         # If the user does not exist
         if backend_user is None:
             log.info("User does not exists")
 
             if user["status"] in (settings.ACTIVE_USER, settings.WCLOSURE_USER):
-                backend_user = self.user_add(user)
+                with timed(self, "add"):
+                    backend_user = self.user_add(user)
 
             elif user["status"] == settings.INACTIVE_USER:
                 log.info("User does not exist in backend, but is marked inactive. Skipping creation.")
@@ -72,10 +217,12 @@ class UserBackend(Backend):
             log.info("User exists")
 
             if user["status"] in (settings.ACTIVE_USER, settings.WCLOSURE_USER, settings.INACTIVE_USER):
-                self.user_mod(backend_user, user)
+                with timed(self, "mod"):
+                    self.user_mod(backend_user, user)
 
             elif user["status"] == settings.DELETED_USER:
-                self.user_del(backend_user)
+                with timed(self, "del"):
+                    self.user_del(backend_user)
 
         log.info("Done processing user %s in backend %s (backend user: %s)",
             username, self.__class__.__name__, backend_user)
@@ -3,22 +3,67 @@
 import logging
 import hashlib
 import random
+import threading
 
 import settings
 import backends
 import apis.google
+import utils.diff
+import utils.groups
 
 log = logging.getLogger("user_daemon.google")
 
 class GoogleBackend(backends.UserBackend):
+    RECONCILE = True
+
     def __init__(self):
         self.g_api = apis.google.get_api(settings.GOOGLE_TOKEN, settings.DOMAIN,
             debug=settings.DEBUG)
+        self.g_batch = apis.google.get_batch(self.g_api, settings.DOMAIN,
+            settings.GOOGLE_BATCH_SIZE)
+
+        # Updates waiting to be sent in bulk, see settings.GOOGLE_BATCH_UPDATES
+        self.pending_mods = {}
+        self.pending_lock = threading.Lock()
+
+        self.writes = utils.diff.WriteStats()
+
+        self.groups = utils.groups.GroupSync(str(self), self.g_batch.groups_get,
+            self.g_batch.groups_mod, settings.GROUP_SNAPSHOT_TTL_SEC)
 
 
     def fetch_backend_user(self, username):
         log.info("Querying for user %s", username)
-        return self.g_api.user_get(username)
+        with apis.timed_call("google", "user_get"):
+            return self.g_api.user_get(username)
+
+
+    def fetch_backend_users(self, usernames):
+        log.info("Querying for %d users", len(usernames))
+        users, errors = self.g_batch.users_get(usernames)
+        for username, error in errors.items():
+            log.warning("Batched lookup of user %s failed: %s", username, error)
+
+        # A 404 is definitive, failed lookups are tried again one by one
+        return dict((username, user is None and backends.MISSING or user)
+            for username, user in users.items())
+
+
+    def flush(self):
+        with self.pending_lock:
+            backend_users, self.pending_mods = self.pending_mods, {}
+
+        if not backend_users:
+            return set()
+
+        errors = self.g_batch.users_mod(backend_users)
+        for username, error in errors.items():
+            log.error("Batched update of user %s failed: %s", username, error)
+        return set(errors)
+
+    def discard(self):
+        with self.pending_lock:
+            self.pending_mods = {}
 
 
     def user_add(self, user):
@@ -30,29 +75,77 @@ class GoogleBackend(backends.UserBackend):
             tmppass = "".join([random.choice(string.letters) for x in range(32)])
     
     
-        return self.g_api.user_add(
-            user["username"],
-            user["first_name"],
-            user["last_name"],
-            self._gapps_sha1_password(tmppass),
-            suspended=self._is_suspended_str(user),
-        )
+        with apis.timed_call("google", "user_add"):
+            return self.g_api.user_add(
+                user["username"],
+                user["first_name"],
+                user["last_name"],
+                self._gapps_sha1_password(tmppass),
+                suspended=self._is_suspended_str(user),
+            )
     
     def user_mod(self, gapps_user, user):
         log.info("Updating user %s", user["username"])
-        
-        gapps_user["name"]["familyName"] = user["last_name"]
-        gapps_user["name"]["givenName"]  = user["first_name"]
-        gapps_user["suspended"] = self._is_suspended_str(user)
-    
+
+        changes = utils.diff.diff(self._current(gapps_user), self._desired(user))
+
+        # The Directory API update call has patch semantics, so only the
+        # changed fields are sent. Both name parts go together.
+        body = {}
+        if "givenName" in changes or "familyName" in changes:
+            body["name"] = {"givenName": user["first_name"], "familyName": user["last_name"]}
+        if "suspended" in changes:
+            body["suspended"] = changes["suspended"]
+
         if user["tmppass"]:
             log.info("Updating password for %s", user["username"])
-            gapps_user["password"] = self._gapps_sha1_password(user["tmppass"])
-            gapps_user["hashFunction"] = 'SHA-1'
-    
-        return self.g_api.user_mod(user["username"], gapps_user)
+            body["password"] = self._gapps_sha1_password(user["tmppass"])
+            body["hashFunction"] = 'SHA-1'
+
+        if not self.writes.record(body):
+            log.info("User %s is up to date, writes: %s", user["username"], self.writes)
+            return
+
+        log.info("Changed fields for %s: %s", user["username"], ", ".join(sorted(body)))
+        if settings.GOOGLE_BATCH_UPDATES:
+            with self.pending_lock:
+                self.pending_mods[user["username"]] = body
+        else:
+            with apis.timed_call("google", "user_mod"):
+                return self.g_api.user_mod(user["username"], body)
     
     
+    def _current(self, gapps_user):
+        name = gapps_user.get("name", {})
+        return {
+            "givenName": name.get("givenName"),
+            "familyName": name.get("familyName"),
+            "suspended": str(gapps_user.get("suspended")).lower(),
+        }
+
+    def _desired(self, user):
+        return {
+            "givenName": user["first_name"],
+            "familyName": user["last_name"],
+            "suspended": self._is_suspended_str(user),
+        }
+
+    def reconcile_state(self, user):
+        if user["status"] == settings.DELETED_USER:
+            return None
+        return self._desired(user), user["status"] != settings.INACTIVE_USER
+
+    def iter_backend_state(self):
+        suffix = "@" + settings.DOMAIN
+        for gapps_user in self.g_batch.iter_users(settings.RECONCILE_PAGE_SIZE):
+            email = gapps_user.get("primaryEmail", "")
+            if email.endswith(suffix):
+                yield email[:-len(suffix)], self._current(gapps_user)
+
+    def sync_groups(self, groups):
+        with backends.timed(self, "groups"):
+            self.groups.sync(groups)
+
     def user_del(self, backend_user, user):
         log.error("Don't know how to delete users yet!")
         raise NotImplemented()
@@ -2,31 +2,62 @@
 
 import logging
 import time
-import subprocess
-import datetime
+import threading
 
 import settings
 import backends
 import apis.ipa
+import apis.kerberos
+import utils.diff
+import utils.groups
 
 log = logging.getLogger("user_daemon.ipa")
 
 # IPA constants
 IPA_DEFAULT_GROUPS = [u"ipausers", ]
 
-RENEW_TICKET_EVERY_SEC    = 60 * 60
 SEND_WARN_EMAIL_EVERY_SEC = 3600
 
 class IpaBackend(backends.UserBackend):
+    RECONCILE = True
+
     def __init__(self):
-        self.last_ticket_renew = None
+        self.last_warn = None
+
+        # Renews the Kerberos ticket in the background
+        self.credentials = None
+        if not settings.DEBUG:
+            self.credentials = apis.kerberos.CredentialManager(
+                renew_before=settings.KERBEROS_RENEW_BEFORE_SEC,
+                check_interval=settings.KERBEROS_CHECK_INTERVAL_SEC)
+            self.credentials.start()
+
+        # Passwords waiting to be written in bulk, see settings.IPA_BATCH_PASSWORDS
+        self.pending_passwords = {}
+        self.pending_lock = threading.Lock()
+
+        self.writes = utils.diff.WriteStats()
 
         self.ipa_api = apis.ipa.get_api("stjornbord", settings.IPA_LDAP_PASS,
+            ldap_uri=settings.IPA_LDAP_URI,
+            ldap_pool_size=settings.IPA_LDAP_POOL_SIZE,
+            confirm_timeout=settings.IPA_PASSWORD_CONFIRM_TIMEOUT_SEC,
             debug=settings.DEBUG)
 
+        self.groups = utils.groups.GroupSync(str(self), self.ipa_api.groups_get,
+            self.ipa_api.groups_mod, settings.GROUP_SNAPSHOT_TTL_SEC)
+
 
     def tick(self):
-        self._renew_ticket()
+        if self.credentials is None:
+            return
+
+        # If the ticket has expired, read the ticket cache again in case an
+        # admin has just run kinit.
+        if not self.credentials.usable():
+            self.credentials.refresh()
+            if not self.credentials.usable():
+                self.kerberos_warn()
 
     def process_user(self, user):
         # Wrap parent's process_user call to catch a ticket expired exception.
@@ -35,11 +66,36 @@ class IpaBackend(backends.UserBackend):
         except apis.ipa.IpaTicketExpired, e:
             self.kerberos_warn()
 
+    def flush(self):
+        with self.pending_lock:
+            passwords, self.pending_passwords = self.pending_passwords, {}
+
+        if not passwords:
+            return set()
+
+        try:
+            with backends.timed(self, "password"):
+                return self.ipa_api.update_passwords(passwords)
+        except apis.ipa.IpaTicketExpired, e:
+            self.kerberos_warn()
+
+    def discard(self):
+        with self.pending_lock:
+            self.pending_passwords = {}
+
 
     def fetch_backend_user(self, username):
         # Fetch user_info
         log.info("Querying user %s", username)
         return self.ipa_api.user_get(username)
+
+    def fetch_backend_users(self, usernames):
+        log.info("Querying %d users", len(usernames))
+        users = self.ipa_api.users_get(usernames)
+        # The search is definitive, users it didn't find don't exist
+        for username in usernames:
+            users.setdefault(username, backends.MISSING)
+        return users
         
     
     def user_add(self, user):
@@ -50,7 +106,7 @@ class IpaBackend(backends.UserBackend):
             uidnumber=user["posix_uid"], gidnumber=user["posix_uid"])
 
         if backend_user:
-            self.ipa_api.update_password(user["username"], user["tmppass"])
+            self.update_password(user)
 
         return backend_user
 
@@ -58,11 +114,61 @@ class IpaBackend(backends.UserBackend):
     def user_mod(self, backend_user, user):
         log.info("Updating user %s", user["username"])
 
+        changes = utils.diff.diff(self._current(backend_user), self._desired(user))
+
+        if self.writes.record(changes):
+            log.info("Changed attributes for %s: %s", user["username"], ", ".join(sorted(changes)))
+            self.ipa_api.user_mod(user["username"], backend_user, **changes)
+        else:
+            log.info("User %s is up to date, writes: %s", user["username"], self.writes)
+
+        self.update_password(user)
+
+    def _current(self, backend_user):
+        return {
+            "givenname": apis.ipa.first_value(backend_user.get("givenname")),
+            "sn": apis.ipa.first_value(backend_user.get("sn")),
+            "enabled": not backend_user.get("nsaccountlock", False),
+        }
+
+    def _desired(self, user):
+        return {
+            "givenname": user["first_name"],
+            "sn": user["last_name"],
+            "enabled": self._is_enabled(user),
+        }
+
+    def reconcile_state(self, user):
+        if user["status"] == settings.DELETED_USER:
+            return None
+        # Inactive users are only updated if they exist
+        return self._desired(user), user["status"] != settings.INACTIVE_USER
+
+    def iter_backend_state(self):
+        for username, backend_user in self.ipa_api.iter_users(settings.RECONCILE_PAGE_SIZE):
+            yield username, self._current(backend_user)
+
+    def sync_groups(self, groups):
+        # IPA keeps its default groups in line itself
+        groups = dict((name, members) for name, members in groups.items()
+            if name not in IPA_DEFAULT_GROUPS)
+        try:
+            with backends.timed(self, "groups"):
+                self.groups.sync(groups)
+        except apis.ipa.IpaTicketExpired, e:
+            self.kerberos_warn()
 
-        self.ipa_api.user_mod(user["username"], backend_user,
-            enabled=self._is_enabled(user),
-            givenname=user["first_name"], sn=user["last_name"])
-        self.ipa_api.update_password(user["username"], user["tmppass"])
+    def update_password(self, user):
+        if not user["tmppass"]:
+            return
+
+        if settings.IPA_BATCH_PASSWORDS:
+            log.info("Queueing password update for %s", user["username"])
+            with self.pending_lock:
+                self.pending_passwords[user["username"]] = user["tmppass"]
+        else:
+            with backends.timed(self, "password"):
+                self.ipa_api.update_password(user["username"], user["tmppass"])
 
     def delete_user(self, backend_user, user):
         log.error("Don't know how to delete users yet!")
@@ -73,22 +179,12 @@ class IpaBackend(backends.UserBackend):
             return True
         return False
 
-    def _renew_ticket(self):
-        if settings.DEBUG:
-            return
-
-        now = datetime.datetime.now()
-        if (self.last_ticket_renew is None or
-              (now - self.last_ticket_renew).seconds > RENEW_TICKET_EVERY_SEC):
-            p = subprocess.Popen(["kinit", "-R"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            ret = p.wait()
-            log.debug("   kinit renew ret=%s, output: %s", ret, p.stdout.read().strip())
-            if ret == 0:
-                self.last_ticket_renew = now
-            else:
-                self.kerberos_warn()
-
     def kerberos_warn(self):
+        now = time.time()
+        notify = self.last_warn is None or now - self.last_warn >= SEND_WARN_EMAIL_EVERY_SEC
+        if notify:
+            self.last_warn = now
+
         raise backends.NonRetryableException("""Kerberos ticket runninn út!
 
 Kerberos ticket á auth.mr.lan er:
@@ -105,4 +201,4 @@ ekkert gengur.
 
 Kveðja,
 Stjórnborðið
-""")
\ No newline at end of file
+""", retry_after=settings.KERBEROS_RETRY_SEC, notify=notify)
\ No newline at end of file
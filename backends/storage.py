@@ -1,50 +1,176 @@
 import logging
-import subprocess
+import threading
 
 import settings
 import backends
+import apis.recording
+import apis.ssh
+import utils.pool
+import utils.state
 
 log = logging.getLogger("user_daemon.storage")
 
+CREATE_USER_DIR  = "/var/opinn/scripts/create_user_dir.sh"
+ARCHIVE_USER_DIR = "/var/opinn/scripts/archive_user_dir.sh"
+
 
 class StorageBackend(backends.Backend):
+    FINGERPRINT_FIELDS = ["username", "status"]
+
+    def __init__(self):
+        # Users waiting to be created in bulk, see settings.STORAGE_BATCH_CREATE
+        self.pending_creates = []
+        self.pending_lock = threading.Lock()
+
     def process_user(self, user):
+        if self.is_unchanged(user):
+            log.info("User %s unchanged since last applied in backend %s, skipping",
+                user["username"], self)
+            return
+
         status = user["status"]
         if status in (settings.ACTIVE_USER, settings.WCLOSURE_USER):
-            self.create(user)
+            if settings.STORAGE_BATCH_CREATE:
+                with self.pending_lock:
+                    self.pending_creates.append(user)
+            else:
+                self.create(user)
         elif status in (settings.INACTIVE_USER, ):
             pass
         elif status in (settings.DELETED_USER, ):
             self.archive(user)
 
+    def flush(self):
+        with self.pending_lock:
+            users, self.pending_creates = self.pending_creates, []
+
+        if not users:
+            return set()
+        return self.create_many(users)
+
+    def discard(self):
+        with self.pending_lock:
+            self.pending_creates = []
+
     def create(self, user):
         """
         Idempotent create.
         """
         raise NotImplementedError()
 
+    def create_many(self, users):
+        """
+        Idempotent create of a batch of users. Returns the set of usernames
+        that could not be created.
+        """
+        failed = set()
+        for user in users:
+            try:
+                if self.create(user) is False:
+                    failed.add(user["username"])
+            except Exception, e:
+                log.exception("Could not create storage for %s", user["username"])
+                failed.add(user["username"])
+        return failed
+
     def archive(self, user):
         """
         Idempotent archive.
         """
         raise NotImplementedError()
 
+    def archived(self, username, dirty=None):
+        """
+        True once the user's storage has been archived, for the deletion at
+        the `dirty` timestamp if given. Backends that delete users should
+        not do so before this holds.
+        """
+        raise NotImplementedError()
+
 
 class HomeBackend(StorageBackend):
+    def __init__(self):
+        StorageBackend.__init__(self)
+        self.ssh = apis.recording.wrap("ssh", lambda: apis.ssh.SshTransport(
+            settings.STORAGE_HOST, settings.STORAGE_SSH_CONTROL_PATH,
+            timeout=settings.STORAGE_SSH_TIMEOUT_SEC))
+
+        # Archiving can take minutes, so it's done by background workers
+        # from a persistent queue.
+        self.jobs = utils.state.JobQueue(settings.STATE_DB,
+            owner=settings.SHARD_DB and settings.SHARD_INSTANCE or None)
+        self.archiver = utils.pool.JobRunner(self.jobs, "archive", self._archive,
+            size=settings.ARCHIVE_WORKERS, max_attempts=settings.ARCHIVE_MAX_ATTEMPTS,
+            retry_delay=settings.ARCHIVE_RETRY_DELAY_SEC)
+
+    def tick(self):
+        counts = self.jobs.counts("archive")
+        if counts.get("queued") or counts.get("running"):
+            log.info("Archive jobs: %s", ", ".join("%s=%d" % c for c in sorted(counts.items())))
+
     def create(self, user):
         """
         Creates user's home directory on storage server.
         """
         if settings.DEBUG:
             log.warn("Running in debug mode, skipping homedir creation")
+            apis.mock_faults.inject("HomeBackend.create")
             return
 
         username = user["username"]
         log.info("Creating homedir for %s" % username)
-        p = subprocess.Popen(
-            ["ssh", "storage.mr.lan", "/var/opinn/scripts/create_user_dir.sh", username],
-            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        ret = p.wait()
-        log.info("   ssh output: %s" % p.stdout.read().strip())
+        ret, output = self.ssh.run([CREATE_USER_DIR, username])
+        log.info("   ssh output: %s" % output.strip())
         return (ret == 0)
-    
+
+    def create_many(self, users):
+        """
+        Creates home directories for a batch of users with a single remote
+        invocation.
+        """
+        usernames = [user["username"] for user in users]
+        if settings.DEBUG:
+            log.warn("Running in debug mode, skipping homedir creation for %d users", len(usernames))
+            apis.mock_faults.delay()
+            return set(username for username in usernames if apis.mock_faults.fails())
+
+        log.info("Creating homedirs for %s" % ", ".join(usernames))
+        results = self.ssh.run_many(CREATE_USER_DIR, usernames)
+
+        failed = set()
+        for username in usernames:
+            if username not in results:
+                log.error("No result creating homedir for %s", username)
+                failed.add(username)
+                continue
+
+            ret, output = results[username]
+            log.info("   %s: ret=%s, output: %s", username, ret, output)
+            if ret != 0:
+                failed.add(username)
+        return failed
+
+    def archive(self, user):
+        """
+        Queues the user's home directory for archiving, returns once the
+        job has been durably queued.
+        """
+        log.info("Queueing homedir archive for %s", user["username"])
+        self.archiver.submit(user["username"], user["dirty"])
+
+    def archived(self, username, dirty=None):
+        return self.jobs.status("archive", username, dirty) == "done"
+
+    def _archive(self, job_id, username):
+        if settings.DEBUG:
+            log.warn("Running in debug mode, skipping homedir archiving")
+            apis.mock_faults.inject("HomeBackend.archive")
+            return
+
+        log.info("Archiving homedir for %s", username)
+        ret, output = self.ssh.run([ARCHIVE_USER_DIR, username],
+            callback=lambda line: self.jobs.progress(job_id, line),
+            timeout=settings.ARCHIVE_TIMEOUT_SEC)
+        log.info("   ssh output: %s" % output.strip())
+        if ret != 0:
+            raise apis.ssh.SshException("%s exited with %d" % (ARCHIVE_USER_DIR, ret))
@@ -0,0 +1,330 @@
+#!/usr/bin/python
+# coding: utf-8
+"""
+Throughput benchmark. Runs main.poll against a local Stjornbord stand-in
+and the mock APIs, one fresh process per batch size, and writes the
+results as JSON.
+
+    $ python benchmark.py --users 100,1000,10000 --latency-ms 5 --failure-rate 0.01 -o new.json
+    $ python benchmark.py --compare old.json new.json
+
+With --replay the API calls are answered from a recording made with
+settings.API_RECORD_FILE, with the recorded latencies, instead of by the
+mocks.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import gzip
+import json
+import logging
+import math
+import optparse
+import os
+import resource
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the dirty user list and group memberships, and accepts dirty
+    bit clears the way Stjornbord does, including paging and bulk clearing.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, code, body="", headers=()):
+        if body and "gzip" in self.headers.get("Accept-Encoding", ""):
+            buf = StringIO.StringIO()
+            fp = gzip.GzipFile(fileobj=buf, mode="w", compresslevel=1)
+            fp.write(body)
+            fp.close()
+            body = buf.getvalue()
+            headers = list(headers) + [("Content-Encoding", "gzip")]
+
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        form = urlparse.parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        path, _, query = self.path.partition("?")
+        query = urlparse.parse_qs(query)
+        with server.lock:
+            server.requests += 1
+
+        if path == "/dirty/users/":
+            with server.lock:
+                users = [user for user in server.users if user["username"] not in server.cleared]
+            headers = [("X-Stjornbord-Bulk-Clean", "1")]
+            if "limit" in query:
+                # Keyset paging on username, the list shrinks as dirty bits
+                # are cleared so offsets would skip users.
+                users.sort(key=lambda user: user["username"])
+                if "cursor" in query:
+                    cursor = query["cursor"][0]
+                    users = [user for user in users if user["username"] > cursor]
+                limit = int(query["limit"][0])
+                if limit < len(users):
+                    headers.append(("X-Next-Cursor", users[limit - 1]["username"]))
+                users = users[:limit]
+            self._respond(200, json.dumps(users), headers)
+
+        elif path == "/clean/users/":
+            results = {}
+            with server.lock:
+                for username, dirty in json.loads(form["users"][0]):
+                    server.cleared.add(username)
+                    results[username] = "cleared"
+            self._respond(200, json.dumps(results))
+
+        elif path == "/groups/":
+            # One group per hundred users
+            groups = {}
+            with server.lock:
+                for i, user in enumerate(server.users):
+                    groups.setdefault("bench-group%d" % (i // 100), []).append(user["username"])
+            self._respond(200, json.dumps(groups))
+
+        elif path.startswith("/clean/user/"):
+            with server.lock:
+                server.cleared.add(path.split("/")[3])
+            self._respond(200, "ok")
+
+        else:
+            self._respond(404)
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+        self.lock = threading.Lock()
+        self.reset(0)
+
+    def reset(self, count):
+        with self.lock:
+            self.users = [{
+                "username": "bench%d" % i,
+                "dirty": "2014-01-01 00:00:%06d" % i,
+                "status": 1,
+                "first_name": u"Jón",
+                "last_name": u"Jónsson %d" % i,
+                "tmppass": "tmp%d" % i if i % 10 == 0 else "",
+                "posix_uid": 10000 + i,
+            } for i in range(count)]
+            self.cleared = set()
+            self.requests = 0
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    # Nearest rank
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def run_case(options):
+    """
+    Runs in a child process. Points the daemon at the stand-in, processes
+    one poll cycle and prints the result as JSON on stdout.
+    """
+    state_root = tempfile.mkdtemp(prefix="user-daemon-bench-")
+    try:
+        import settings
+        base = "http://127.0.0.1:%d" % options.port
+        settings.DEBUG = True
+        settings.DIRTY_USERS = base + "/dirty/users/"
+        settings.CLEAN_DIRTY = base + "/clean/user/%s/%s/"
+        settings.CLEAN_DIRTY_BULK = base + "/clean/users/"
+        settings.GROUPS = base + "/groups/"
+        settings.STATE_ROOT = settings.LOGGING_ROOT = state_root
+        settings.STATE_DB = os.path.join(state_root, "update_daemon.db")
+        settings.WORKER_COUNT = options.workers
+        if options.page_size:
+            settings.DIRTY_USERS_PAGE_SIZE = options.page_size
+
+        import apis
+        import apis.recording
+        import main
+        main.log = logging.getLogger("user_daemon")
+        apis.recording.configure(record=options.record, replay=options.replay)
+        apis.mock_faults.latency = options.latency_ms / 1000.0
+        apis.mock_faults.failure_rate = options.failure_rate
+
+        latencies = []
+        process_user = main.process_user
+        def timed_process_user(my_backends, user, progress):
+            start = time.time()
+            try:
+                return process_user(my_backends, user, progress)
+            finally:
+                latencies.append(time.time() - start)
+        main.process_user = timed_process_user
+
+        my_backends = main.init_backends()
+
+        # Deferred work (passwords, Google updates, homedirs) is done when
+        # the backends flush after each batch, and each user in the batch
+        # waits for it, so its duration is added to their latencies.
+        flush_times = []
+        def timed_flush(flush):
+            def _flush():
+                start = time.time()
+                try:
+                    return flush()
+                finally:
+                    flush_times.append(time.time() - start)
+            return _flush
+        for backend in my_backends:
+            backend.flush = timed_flush(backend.flush)
+
+        total_flush = [0.0]
+        _process = main._process
+        def timed_process(my_backends, dirty, clear):
+            first = len(latencies)
+            del flush_times[:]
+            try:
+                return _process(my_backends, dirty, clear)
+            finally:
+                flushed = sum(flush_times)
+                total_flush[0] += flushed
+                for i in range(first, len(latencies)):
+                    latencies[i] += flushed
+        main._process = timed_process
+        start = time.time()
+        processed = main.poll(my_backends)
+        elapsed = time.time() - start
+
+        json.dump({
+            "processed": processed,
+            "elapsed_sec": round(elapsed, 3),
+            "flush_sec": round(total_flush[0], 3),
+            "users_per_sec": round(len(latencies) / elapsed, 1) if elapsed else None,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+            # Kilobytes on Linux
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }, sys.stdout)
+    finally:
+        shutil.rmtree(state_root, ignore_errors=True)
+
+
+def run(options):
+    server = StandInServer()
+    t = threading.Thread(target=server.serve_forever, name="stand-in")
+    t.daemon = True
+    t.start()
+
+    results = []
+    for count in [int(count) for count in options.users.split(",")]:
+        server.reset(count)
+        args = [sys.executable, os.path.abspath(__file__), "--case",
+            "--port", str(server.server_address[1]),
+            "--workers", str(options.workers),
+            "--latency-ms", str(options.latency_ms),
+            "--failure-rate", str(options.failure_rate),
+            "--page-size", str(options.page_size or 0),
+            "--log-level", options.log_level]
+        for name in ("record", "replay"):
+            if getattr(options, name):
+                args += ["--" + name, os.path.abspath(getattr(options, name))]
+        output = subprocess.check_output(args, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        result = {"users": count, "requests": server.requests}
+        result.update(json.loads(output))
+        results.append(result)
+        print >> sys.stderr, ("%(users)7d users: %(users_per_sec)9.1f users/s, p50 %(p50_ms).2f ms, "
+            "p99 %(p99_ms).2f ms, peak RSS %(peak_rss_kb)d KB" % result)
+
+    server.shutdown()
+    return {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "config": {
+            "workers": options.workers,
+            "latency_ms": options.latency_ms,
+            "failure_rate": options.failure_rate,
+            "page_size": options.page_size,
+            "replay": options.replay,
+        },
+        "results": results,
+    }
+
+
+def compare(old_file, new_file):
+    old = json.load(open(old_file))
+    new = json.load(open(new_file))
+    if old["config"] != new["config"]:
+        print "Warning: configurations differ, %s vs %s" % (old["config"], new["config"])
+
+    old_results = dict((result["users"], result) for result in old["results"])
+    print "%7s %22s %22s %22s" % ("users", "users/s", "p99 ms", "peak RSS KB")
+    for result in new["results"]:
+        before = old_results.get(result["users"])
+        if before is None:
+            continue
+        columns = []
+        for key in ("users_per_sec", "p99_ms", "peak_rss_kb"):
+            a, b = before[key], result[key]
+            change = a and "%+.1f%%" % ((b - a) * 100.0 / a) or "n/a"
+            columns.append("%10s %s" % (b, change.rjust(11)))
+        print "%7d %s" % (result["users"], " ".join(columns))
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [options] | --compare OLD NEW")
+    parser.add_option("--users", default="100,1000,10000,50000",
+        help="comma separated batch sizes, default %default")
+    parser.add_option("--workers", type="int", default=1,
+        help="settings.WORKER_COUNT, default %default")
+    parser.add_option("--latency-ms", type="float", default=0.0,
+        help="latency injected into each mock API call")
+    parser.add_option("--failure-rate", type="float", default=0.0,
+        help="probability of an injected failure per mock API call and user")
+    parser.add_option("--page-size", type="int", default=0,
+        help="settings.DIRTY_USERS_PAGE_SIZE, 0 fetches the list in one go")
+    parser.add_option("--log-level", default="ERROR",
+        help="log level of the daemon under test, default %default")
+    parser.add_option("--record", metavar="FILE",
+        help="record the mock API calls to FILE, see apis.recording")
+    parser.add_option("--replay", metavar="FILE",
+        help="answer API calls from a recording instead of the mocks")
+    parser.add_option("-o", "--output", help="write results to this file instead of stdout")
+    parser.add_option("--compare", action="store_true", default=False,
+        help="compare two result files")
+    parser.add_option("--case", action="store_true", default=False, help=optparse.SUPPRESS_HELP)
+    parser.add_option("--port", type="int", help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, options.log_level.upper()), stream=sys.stderr)
+
+    if options.compare:
+        if len(args) != 2:
+            parser.error("--compare takes two result files")
+        compare(*args)
+    elif options.case:
+        run_case(options)
+    else:
+        report = run(options)
+        if options.output:
+            with open(options.output, "w") as fp:
+                json.dump(report, fp, indent=2)
+        else:
+            json.dump(report, sys.stdout, indent=2)
+            print
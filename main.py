@@ -1,25 +1,87 @@
 #!/usr/bin/python
 # coding: utf-8
 
+import atexit
+import errno
+import httplib
 import json
 import logging
+import optparse
 import os.path
+import signal
+import socket
 import sys
+import threading
 import time
 import urllib
 import urllib2
+import urlparse
+import zlib
 
 import settings
+import apis.command
+import apis.recording
 import backends
 import utils.dictconfig
+import utils.diff
+import utils.jsonstream
+import utils.log
+import utils.metrics
+import utils.pool
+import utils.shard
+import utils.state
+import utils.tracing
 
 POST_SYNC_SECRET = SYNC_SECRET = urllib.urlencode((("secret", settings.SYNC_SECRET),)) 
 
+# Per backend semaphores, see settings.BACKEND_CONCURRENCY
+backend_slots = {}
+
+# Usernames currently being pushed through the backend chain
+inflight = set()
+inflight_lock = threading.Lock()
+
+pool = None
+
+# Backend progress of partially processed users, see utils.state.Journal
+journal = None
+
+# Backoff and quarantine of failing users, see utils.state.RetrySchedule
+retries = None
+
+# Fingerprints of applied user data, see utils.state.ShadowStore
+shadow = None
+
+# This instance's share of the users, see settings.SHARD_DB
+shard = None
+
+# Toggled with settings.PROFILE_SIGNAL, see utils.tracing.CycleProfiler
+profiler = utils.tracing.CycleProfiler(settings.LOGGING_ROOT, settings.PROFILE_CYCLES)
+
+# Header Stjornbord sets on the dirty user list when it accepts bulk clears
+BULK_CLEAN_HEADER = "X-Stjornbord-Bulk-Clean"
+
+# Header Stjornbord sets on a page of dirty users when there are more pages
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+POLL_DURATION = utils.metrics.Histogram("user_daemon_poll_duration_seconds",
+    "Duration of a poll cycle")
+DIRTY_USERS = utils.metrics.Gauge("user_daemon_dirty_users",
+    "Dirty users seen in the last poll")
+USERS = utils.metrics.Counter("user_daemon_users_total",
+    "Users pushed through the backend chain, by result", ["result"])
+CLEAR_DURATION = utils.metrics.Histogram("user_daemon_clear_duration_seconds",
+    "Duration of dirty bit clearing requests", ["mode"])
+RECONCILE_DIVERGENT = utils.metrics.Gauge("user_daemon_reconcile_divergent_users",
+    "Users found to differ from Stjornbord in the last reconciliation", ["backend"])
+
 def init_logging():
     """
     Set up logging, see config in the settings module
     """
     utils.dictconfig.dictConfig(settings.LOGGING)
+    if settings.LOG_QUEUE:
+        utils.log.install_queue(settings.LOGGING["loggers"])
 
     return logging.getLogger("user_daemon")
 
@@ -27,7 +89,15 @@ def init_backends():
     """
     Import backends, logic borrowed from Django.
     """
+    global journal, retries, shadow
+
     my_backends = []
+    if settings.SHADOW_TTL_SEC:
+        shadow = utils.state.ShadowStore(settings.STATE_DB)
+    if settings.JOURNAL_ENABLED:
+        journal = utils.state.Journal(settings.STATE_DB)
+    retries = init_retries()
+
     # Logic borrowed from django.middleware.base
     for backend_path in settings.BACKENDS:
         module, classname = backend_path.rsplit('.', 1)
@@ -42,43 +112,420 @@ def init_backends():
         except AttributeError:
             raise RuntimeError('Backend module "%s" does not define a "%s" class' % (module, classname))
 
-        my_backends.append(klass())
+        backend = klass()
+        backend.shadow = shadow
+        limit = settings.BACKEND_CONCURRENCY.get(backend_path)
+        if limit:
+            backend_slots[backend] = threading.BoundedSemaphore(limit)
+
+        my_backends.append(backend)
 
     return my_backends
 
+def init_retries():
+    return utils.state.RetrySchedule(settings.STATE_DB, settings.RETRY_BASE_DELAY_SEC,
+        settings.RETRY_MAX_DELAY_SEC, settings.RETRY_MAX_ATTEMPTS)
+
 def poll(my_backends):
     """
     Fetch a list of dirty users and pipe them through processing backends.
     """
+    utils.tracing.tracer.begin_cycle()
+    profiler.begin_cycle()
+    processed = None
+    try:
+        processed = _poll(my_backends)
+        return processed
+    finally:
+        profiler.end_cycle()
+        # Idle cycles aren't worth a trace, failed ones are
+        utils.tracing.tracer.end_cycle(discard=(processed == 0))
 
-    # Tick all backends. This gives them a chance to do background work.
-    for backend in my_backends:
-        backend.tick()
 
-    # Fetch a list of dirty users
-    log.debug("Polling dirty users from %s", settings.DIRTY_USERS)
-    fp = urllib2.urlopen(settings.DIRTY_USERS, POST_SYNC_SECRET)
-    dirty = json.load(fp)
-    fp.close()
+def _poll(my_backends):
+    with POLL_DURATION.time(), utils.tracing.span("poll", "main"):
+        # Tick all backends. This gives them a chance to do background work.
+        for backend in my_backends:
+            backend.tick()
+
+        if shard is not None and shard.refresh():
+            forget_unowned()
+
+        # Users are processed in batches as they are parsed from the response
+        seen = 0
+        processed = 0
+        batch = []
+        for user in iter_dirty_users():
+            seen += 1
+            batch.append(user)
+            if len(batch) >= settings.PROCESS_BATCH_SIZE:
+                processed += process(my_backends, batch)
+                batch = []
+
+        if batch:
+            processed += process(my_backends, batch)
+
+        # After the users, so that new users can be added to groups
+        # Group sync problems must not fail the users, whose dirty bits
+        # have already been cleared.
+        if settings.GROUP_SYNC and (shard is None or shard.is_leader()):
+            try:
+                sync_groups(my_backends)
+            except Exception:
+                log.exception("Could not sync groups")
+
+    DIRTY_USERS.set(seen)
+    log.debug("HTTP connections opened: %(opened)d, reused: %(reused)d", session.stats)
+    return processed
+
+
+def iter_dirty_users():
+    """
+    Yield dirty users as they are parsed from Stjornbord's response. If
+    settings.DIRTY_USERS_PAGE_SIZE is set, the list is fetched a page at a
+    time, following the cursor Stjornbord returns with each page. The
+    response is read ahead of processing, see settings.DIRTY_USERS_READ_AHEAD.
+    """
+    def _on_page(info):
+        clearer.bulk_supported = info.getheader(BULK_CLEAN_HEADER) is not None
+
+    return utils.pool.read_ahead(
+        iter_users(settings.DIRTY_USERS, settings.DIRTY_USERS_PAGE_SIZE, _on_page),
+        settings.DIRTY_USERS_READ_AHEAD)
+
+
+def iter_users(url, page_size=None, on_page=None):
+    """
+    Yield users from a Stjornbord user list as they are parsed, a page of
+    `page_size` users at a time if set. `on_page` is called with the
+    headers of each page.
+    """
+    base = url
+    cursor = None
+    while True:
+        url = base
+        if page_size:
+            params = [("limit", page_size)]
+            if cursor is not None:
+                params.append(("cursor", cursor))
+            url += ("&" if "?" in url else "?") + urllib.urlencode(params)
+
+        log.debug("Fetching users from %s", url)
+        fp = session.post(url, POST_SYNC_SECRET)
+        try:
+            if on_page is not None:
+                on_page(fp.info())
+            cursor = fp.info().getheader(NEXT_CURSOR_HEADER)
+
+            for user in utils.jsonstream.iter_array(fp):
+                yield user
+        finally:
+            fp.close()
+
+        if not page_size or cursor is None:
+            return
+
+
+def sync_groups(my_backends):
+    """
+    Fetch the desired group memberships from Stjornbord, a JSON object of
+    group name to list of usernames, and have each backend bring its
+    groups in line. Backends only read and change the groups that differ,
+    see utils.groups.GroupSync.
+    """
+    with utils.tracing.span("groups", "main"):
+        fp = session.post(settings.GROUPS, POST_SYNC_SECRET)
+        try:
+            groups = json.load(fp)
+        finally:
+            fp.close()
+
+        desired = dict((name, set(members)) for name, members in groups.items())
+        for backend in my_backends:
+            try:
+                backend.sync_groups(desired)
+            except Exception:
+                log.exception("Could not sync groups in backend %s", backend)
 
-    return process(my_backends, dirty)
 
-def process(my_backends, dirty):
-    # Iterate through users and process
+def reconcile(my_backends):
+    """
+    Compare every user in Stjornbord with the user stores of backends that
+    support reconciliation, and push the users that have drifted, e.g.
+    through manual edits, through the backend chain. All three user sets
+    are streamed: Stjornbord's is reduced to a utils.diff.DigestIndex, each
+    backend's is checked against it, and divergent users are picked out
+    of a second pass over Stjornbord's list. Returns the number of users
+    successfully processed.
+    """
+    start = time.time()
+    targets = [backend for backend in my_backends if backend.RECONCILE]
+
+    index = utils.diff.DigestIndex(len(targets))
+    for user in iter_users(settings.ALL_USERS, settings.RECONCILE_PAGE_SIZE):
+        index.add(user["username"], [backend.reconcile_state(user) for backend in targets])
+    log.info("Reconciling %d users from Stjornbord with %s", len(index),
+        ", ".join(str(backend) for backend in targets))
+
+    divergent = set()
+    for slot, backend in enumerate(targets):
+        differs = set()
+        unknown = 0
+        try:
+            for username, state in backend.iter_backend_state():
+                result = index.check(slot, username, state)
+                if result == utils.diff.DIFFERS:
+                    differs.add(username)
+                elif result == utils.diff.UNKNOWN:
+                    unknown += 1
+        except backends.NonRetryableException:
+            raise
+        except Exception:
+            log.exception("Could not list users in backend %s, not reconciling it", backend)
+            continue
+
+        missing = set(index.missing(slot))
+        log.info("Backend %s: %d users differ, %d missing, %d not in Stjornbord",
+            backend, len(differs), len(missing), unknown)
+        RECONCILE_DIVERGENT.set(len(differs) + len(missing), backend=str(backend))
+        divergent.update(differs)
+        divergent.update(missing)
+
+    # Other instances reconcile their own users
+    if shard is not None:
+        divergent = set(username for username in divergent if shard.owns(username))
+
+    if not divergent:
+        log.info("Reconciliation found no divergent users in %.1f seconds", time.time() - start)
+        return 0
+
+    # What was applied no longer matches the backends
+    if shadow is not None:
+        shadow.forget(divergent)
+
     processed = 0
+    batch = []
+    for user in utils.pool.read_ahead(iter_users(settings.ALL_USERS, settings.RECONCILE_PAGE_SIZE),
+            settings.DIRTY_USERS_READ_AHEAD):
+        if user["username"] not in divergent:
+            continue
+        batch.append(user)
+        if len(batch) >= settings.PROCESS_BATCH_SIZE:
+            processed += process(my_backends, batch, clear=False)
+            batch = []
+
+    if batch:
+        processed += process(my_backends, batch, clear=False)
+
+    log.info("Reconciled %d of %d divergent users in %.1f seconds", processed,
+        len(divergent), time.time() - start)
+    return processed
+
+
+def process(my_backends, dirty, clear=True):
+    """
+    Push dirty users through the backend chain, returns the number of
+    users successfully processed. With settings.WORKER_COUNT > 1 users are
+    processed concurrently, but each user still visits the backends in order.
+    Dirty bits are cleared once the backends have flushed any deferred work,
+    unless `clear` is False.
+    """
+    # A user may only be processed by one worker at a time, so only keep
+    # the most recent entry for each username.
+    users = {}
     for user in dirty:
-        log.info("Processing user %s", user["username"])
+        users[user["username"]] = user
+    dirty = [user for user in dirty if users[user["username"]] is user]
+
+    if shard is None:
+        return _process(my_backends, dirty, clear)
+
+    # Users that belong to other instances, or that another instance is
+    # still working on while the shards rebalance, are left alone
+    claimed = shard.claim([user["username"] for user in dirty])
+    if len(claimed) < len(dirty):
+        log.debug("Leaving %d users to other instances", len(dirty) - len(claimed))
+    try:
+        return _process(my_backends, [user for user in dirty if user["username"] in claimed], clear)
+    finally:
+        shard.release(claimed)
+
+
+def _process(my_backends, dirty, clear):
+    # Users that failed recently are left for later
+    if retries is not None:
+        due = retries.filter_due(dirty)
+        if len(due) < len(dirty):
+            log.info("Skipping %d users that are backing off or quarantined", len(dirty) - len(due))
+        dirty = due
+
+    # Backends that completed each user, in order
+    progress = {}
+
+    try:
+        done, failed, flush_failed = _apply(my_backends, dirty, progress)
+    except backends.NonRetryableException, e:
+        # Deferred work of the aborted batch would otherwise go out with
+        # the next flush
+        exc_info = sys.exc_info()
+        for backend in my_backends:
+            backend.discard()
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    processed = []
+    for user in done:
+        if user["username"] in failed:
+            log.error("Could not process user %s, deferred backend work failed", user["username"])
+            if retries is not None:
+                retries.failed(user, "Deferred work failed in %s" % ", ".join(sorted(
+                    backend for backend, usernames in flush_failed.items() if user["username"] in usernames)))
+            continue
+
+        if clear:
+            clearer.add(user)
+        processed.append(user)
+
+    USERS.inc(len(processed), result="processed")
+    USERS.inc(len(dirty) - len(processed), result="failed")
+
+    for backend in my_backends:
+        backend.record_applied(processed)
+    if retries is not None:
+        retries.succeeded([user["username"] for user in processed])
+
+    # Journal backends that completed users which are still dirty. This is
+    # done after flushing, so that deferred work is part of the journal.
+    if journal is not None:
+        entries = []
+        ok = set(id(user) for user in processed)
+        for user in dirty:
+            if id(user) in ok:
+                continue
+            for backend in progress.get(user["username"], ()):
+                if user["username"] not in flush_failed.get(backend, ()):
+                    entries.append((user["username"], backend, user["dirty"]))
+
+        journal.complete(entries)
+        journal.forget([user["username"] for user in processed])
+
+    clearer.flush()
+    return len(processed)
+
+
+def _apply(my_backends, dirty, progress):
+    """
+    Run a batch of users through the backends and flush their deferred
+    work. Returns the users that completed, the usernames whose deferred
+    work failed and those per backend.
+    """
+    global pool
+
+    for backend in my_backends:
         try:
-            for backend in my_backends:
-                backend.process_user(user)
+            backend.prefetch(dirty)
         except Exception, e:
-            log.exception("Could not process user %s", user["username"])
-            continue
-        
-        clear_dirtybit(user)
-        processed += 1
+            log.exception("Could not prefetch users in backend %s, falling back "
+                "to individual lookups", backend)
 
-    return processed
+    if settings.WORKER_COUNT <= 1:
+        done = [user for user in dirty if process_user(my_backends, user, progress)]
+    else:
+        if pool is None:
+            pool = utils.pool.WorkerPool(settings.WORKER_COUNT)
+
+        results = []
+        fatal = []
+        def _process_user(user):
+            if fatal:
+                return
+            try:
+                results.append((process_user(my_backends, user, progress), user))
+            except backends.NonRetryableException, e:
+                fatal.append(e)
+
+        for user in dirty:
+            pool.submit(_process_user, user)
+        pool.join()
+
+        if fatal:
+            raise fatal[0]
+
+        # Keep the original order
+        ok = set(id(user) for success, user in results if success)
+        done = [user for user in dirty if id(user) in ok]
+
+    failed = set()
+    flush_failed = {}
+    for backend in my_backends:
+        try:
+            with backends.timed(backend, "flush"):
+                flush_failed[str(backend)] = backend.flush()
+        except backends.NonRetryableException, e:
+            raise
+        except Exception, e:
+            log.exception("Could not flush backend %s", backend)
+            flush_failed[str(backend)] = set(user["username"] for user in dirty)
+        failed.update(flush_failed[str(backend)])
+
+    return done, failed, flush_failed
+
+
+def process_user(my_backends, user, progress):
+    """
+    Run a single user through all backends, skipping those the journal
+    says have completed the user already. The backends that complete the
+    user are appended to progress[username]. Returns True on success.
+    """
+    username = user["username"]
+    with inflight_lock:
+        if username in inflight:
+            log.info("User %s is already being processed, skipping", username)
+            return False
+        inflight.add(username)
+
+    try:
+        with utils.tracing.span("user", "main", username=username):
+            return _process_user(my_backends, user, progress)
+    finally:
+        with inflight_lock:
+            inflight.discard(username)
+
+
+def _process_user(my_backends, user, progress):
+    username = user["username"]
+    log.info("Processing user %s", username)
+
+    completed = set()
+    if journal is not None:
+        completed = journal.completed(username, user["dirty"])
+    progress[username] = list(completed)
+
+    try:
+        for backend in my_backends:
+            if str(backend) in completed:
+                log.info("Backend %s already completed user %s, skipping", backend, username)
+                continue
+
+            slot = backend_slots.get(backend)
+            if slot is None:
+                with backends.timed(backend, "process_user"):
+                    backend.process_user(user)
+            else:
+                with slot:
+                    with backends.timed(backend, "process_user"):
+                        backend.process_user(user)
+
+            progress[username].append(str(backend))
+    except backends.NonRetryableException, e:
+        # Not the user's fault, abort the batch
+        raise
+    except Exception, e:
+        log.exception("Could not process user %s", username)
+        if retries is not None:
+            retries.failed(user, "%s: %s" % (e.__class__.__name__, e))
+        return False
+
+    return True
 
 
 def clear_dirtybit(user):
@@ -86,26 +533,317 @@ def clear_dirtybit(user):
     Connect to Stjornbord and clear the user's dirty bit. The clearing condition
     is that the dirty timestamp is the same.
     """
-    query = urllib2.urlopen(settings.CLEAN_DIRTY % (user["username"], user["dirty"]), POST_SYNC_SECRET)
-    http_code = query.getcode()
+    with CLEAR_DURATION.time(mode="single"):
+        query = session.post(settings.CLEAN_DIRTY % (user["username"], user["dirty"]), POST_SYNC_SECRET)
+        http_code = query.getcode()
+        query.read()
+        query.close()
     if http_code == 200:
         log.info("Successfully cleared dirtybit for %s (%s)", user["username"], user["dirty"])
     else:
         log.warning("Failed to clear dirtybit for %s (%s). Return code: %s", user["username"], user["dirty"], http_code)
 
 
-def main():
+class DirtyBitClearer(object):
+    """
+    Collects processed users and clears their dirty bits in bulk, up to
+    settings.CLEAN_DIRTY_BATCH_SIZE users per request. Pending users are sent
+    when the batch is full, when the oldest of them has waited for
+    settings.CLEAN_DIRTY_FLUSH_SEC, or when flush is called. Falls back to
+    clear_dirtybit if Stjornbord doesn't advertise bulk support.
+    """
+    def __init__(self):
+        self.pending = []
+        # When the oldest pending user was added
+        self.oldest = None
+        self.bulk_supported = False
+        self.lock = threading.Lock()
+
+    def add(self, user):
+        with self.lock:
+            if not self.pending:
+                self.oldest = time.time()
+            self.pending.append(user)
+            due = (len(self.pending) >= settings.CLEAN_DIRTY_BATCH_SIZE or
+                time.time() - self.oldest >= settings.CLEAN_DIRTY_FLUSH_SEC)
+
+        if due:
+            self.flush()
+
+    def flush(self):
+        while True:
+            with self.lock:
+                users = self.pending[:settings.CLEAN_DIRTY_BATCH_SIZE]
+                del self.pending[:len(users)]
+                if self.pending:
+                    self.oldest = time.time()
+
+            if not users:
+                return
+
+            if self.bulk_supported and settings.CLEAN_DIRTY_BULK:
+                self._clear_bulk(users)
+            else:
+                for user in users:
+                    clear_dirtybit(user)
+
+    def _clear_bulk(self, users):
+        """
+        Clear dirty bits for many users in one request. The clearing
+        condition is the same as in clear_dirtybit, Stjornbord responds with
+        a JSON object mapping each username to "cleared" or a reason why the
+        bit was left alone.
+        """
+        data = urllib.urlencode((
+            ("secret", settings.SYNC_SECRET),
+            ("users", json.dumps([[user["username"], user["dirty"]] for user in users])),
+        ))
+
+        try:
+            with CLEAR_DURATION.time(mode="bulk"):
+                query = session.post(settings.CLEAN_DIRTY_BULK, data)
+                results = json.load(query)
+                query.close()
+        except urllib2.HTTPError, e:
+            if e.code not in (404, 405):
+                raise
+            log.warning("Bulk dirtybit clearing not available (%s), falling back to "
+                "clearing one user at a time", e.code)
+            self.bulk_supported = False
+            for user in users:
+                clear_dirtybit(user)
+            return
+
+        for user in users:
+            result = results.get(user["username"], "missing from response")
+            if result == "cleared":
+                log.info("Successfully cleared dirtybit for %s (%s)", user["username"], user["dirty"])
+            else:
+                log.warning("Failed to clear dirtybit for %s (%s): %s", user["username"], user["dirty"], result)
+
+
+clearer = DirtyBitClearer()
+
+
+class HttpSession(object):
+    """
+    Keeps persistent connections to Stjornbord and reuses them across
+    requests, asking for gzip compressed responses. Errors are raised as
+    urllib2.URLError/HTTPError so callers can treat them as before.
+    """
+    def __init__(self, connect_timeout, read_timeout):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.stats = {"opened": 0, "reused": 0}
+
+    def _connection(self, key):
+        """
+        Returns a tuple of an idle or a new connection, and whether it
+        was reused.
+        """
+        with self.lock:
+            if self.idle.get(key):
+                self.stats["reused"] += 1
+                return self.idle[key].pop(), True
+
+        scheme, host = key
+        if scheme == "https":
+            conn = httplib.HTTPSConnection(host, timeout=self.connect_timeout)
+        else:
+            conn = httplib.HTTPConnection(host, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+
+        with self.lock:
+            self.stats["opened"] += 1
+        return conn, False
+
+    def release(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def post(self, url, data):
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        headers = {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Accept-Encoding": "gzip",
+        }
+
+        # A reused connection may have been closed by the server while it
+        # was idle, in which case the request is retried on a new one. Other
+        # errors, timeouts in particular, are raised as the request may have
+        # been received.
+        while True:
+            conn, reused = None, False
+            try:
+                conn, reused = self._connection(key)
+                conn.request("POST", path, data, headers)
+                resp = conn.getresponse()
+                break
+            except (socket.error, httplib.HTTPException), e:
+                if conn is not None:
+                    conn.close()
+                stale = (isinstance(e, httplib.BadStatusLine) or
+                    (isinstance(e, socket.error) and e.errno in (errno.ECONNRESET, errno.EPIPE)))
+                if not (reused and stale):
+                    raise urllib2.URLError(e)
+
+        response = HttpResponse(self, key, conn, resp)
+        if not 200 <= resp.status < 300:
+            response.close()
+            raise urllib2.HTTPError(url, resp.status, resp.reason, resp.msg, None)
+        return response
+
+
+class HttpResponse(object):
+    """
+    File like wrapper around a response, transparently decompressing it.
+    The connection goes back to the session once the body has been read
+    and the response closed.
+    """
+    def __init__(self, session, key, conn, resp):
+        self.session = session
+        self.key = key
+        self.conn = conn
+        self.resp = resp
+        self.buffer = ""
+
+        if resp.getheader("Content-Encoding") == "gzip":
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.decompressor = None
+
+    def getcode(self):
+        return self.resp.status
+
+    def info(self):
+        return self.resp.msg
+
+    def _read_raw(self, size):
+        try:
+            if size < 0:
+                return self.resp.read()
+            return self.resp.read(size)
+        except (socket.error, httplib.HTTPException), e:
+            raise urllib2.URLError(e)
+
+    def read(self, size=-1):
+        if self.decompressor is None:
+            return self._read_raw(size)
+
+        while size < 0 or len(self.buffer) < size:
+            chunk = self._read_raw(size < 0 and -1 or 16384)
+            if not chunk:
+                self.buffer += self.decompressor.flush()
+                break
+            self.buffer += self.decompressor.decompress(chunk)
+            if size < 0:
+                break
+
+        if size < 0:
+            data, self.buffer = self.buffer, ""
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        if self.conn is None:
+            return
+
+        if self.resp.isclosed() and not self.resp.will_close:
+            self.session.release(self.key, self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+
+session = HttpSession(settings.HTTP_CONNECT_TIMEOUT_SEC, settings.HTTP_READ_TIMEOUT_SEC)
+
+
+def init_instance(instance=None):
+    """
+    Name this instance for sharding, by default after the host. Instances
+    sharing a host need their own names, given with --instance, and each
+    keeps its local state in its own database.
+    """
+    if instance:
+        root, ext = os.path.splitext(settings.STATE_DB)
+        settings.STATE_DB = "%s-%s%s" % (root, instance, ext)
+        settings.SHARD_INSTANCE = instance
+    elif not settings.SHARD_INSTANCE:
+        settings.SHARD_INSTANCE = socket.gethostname()
+
+
+def forget_unowned():
+    """
+    Forget the shadow state and journal of users this instance no longer
+    owns. Another instance may change them in the backends, and they would
+    be skipped as unchanged if they moved back within SHADOW_TTL_SEC.
+    """
+    for store in (shadow, journal):
+        if store is None:
+            continue
+        usernames = [username for username in store.usernames() if not shard.owns(username)]
+        if usernames:
+            log.info("Forgetting %s of %d users owned by other instances",
+                store.__class__.__name__, len(usernames))
+            store.forget(usernames)
+
+
+def init_shard():
+    log.info("Sharding users as instance %s, coordinated through %s", settings.SHARD_INSTANCE,
+        settings.SHARD_DB)
+    return utils.shard.Shard(settings.SHARD_DB, settings.SHARD_INSTANCE, settings.SHARD_LEASE_SEC,
+        settings.SHARD_VNODES)
+
+
+def main(reconcile_now=False):
+    global shard
     log.info("Starting up!")
     
     poll_failures = 0
+    apis.command.engine.configure(settings.SUBPROCESS_MAX_CONCURRENT, settings.SUBPROCESS_LIMITS)
+    apis.recording.configure(record=settings.API_RECORD_FILE, replay=settings.API_REPLAY_FILE)
     my_backends = init_backends()
 
+    if settings.SHARD_DB:
+        shard = init_shard()
+        shard.start()
+        atexit.register(shard.stop)
+        # The ring may have changed while the instance was down
+        forget_unowned()
+
+    if settings.METRICS_PORT:
+        try:
+            utils.metrics.serve(settings.METRICS_ADDRESS, settings.METRICS_PORT)
+        except socket.error, e:
+            log.error("Could not serve metrics on %s:%d, another instance on the same "
+                "port? %s", settings.METRICS_ADDRESS, settings.METRICS_PORT, e)
+    if settings.TRACE_ENABLED:
+        utils.tracing.tracer.configure(settings.TRACE_ROOT, settings.TRACE_KEEP)
+    signal.signal(settings.PROFILE_SIGNAL, profiler.toggle)
+    # Restart interrupted system calls, or toggling would abort whatever
+    # read was in progress
+    signal.siginterrupt(settings.PROFILE_SIGNAL, False)
+
+    last_reconcile = time.time()
+
     while True:
         processed = 0
         try:
             processed = poll(my_backends)
             poll_failures = 0
 
+            if reconcile_now or (settings.RECONCILE_INTERVAL_SEC and
+                    time.time() - last_reconcile >= settings.RECONCILE_INTERVAL_SEC):
+                last_reconcile = time.time()
+                reconcile_now = False
+                processed += reconcile(my_backends)
+
         except urllib2.URLError, e:
             poll_failures += 1
             log.warn("Fetch failure, reason: %s. Will throw an exception after %d failures.",
@@ -115,8 +853,11 @@ def main():
                 log.exception("Error fetching data from %s. Failures: %d", settings.DIRTY_USERS, poll_failures)
 
         except backends.NonRetryableException, e:
-            t = settings.NON_RETRYABLE_ERROR_SLEEP_SEC
-            log.exception("Non retryable exception raised, going to sleep for %d seconds", t)
+            t = e.retry_after or settings.NON_RETRYABLE_ERROR_SLEEP_SEC
+            if e.notify:
+                log.exception("Non retryable exception raised, going to sleep for %d seconds", t)
+            else:
+                log.warning("Non retryable exception raised again, going to sleep for %d seconds", t)
             time.sleep(t)
 
         except Exception, e:
@@ -128,5 +869,41 @@ def main():
 
 
 if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("--refresh", action="store_true", default=False,
+        help="forget the shadow state, forcing all users through the backends")
+    parser.add_option("--reconcile", action="store_true", default=False,
+        help="reconcile all users with the backends on startup")
+    parser.add_option("--quarantine", action="store_true", default=False,
+        help="list quarantined users and exit")
+    parser.add_option("--release", metavar="USERNAME", action="append", default=[],
+        help="release a user from quarantine and exit, may be repeated")
+    parser.add_option("--instance", metavar="NAME",
+        help="name of this instance when sharding, with its own state database, "
+        "see settings.SHARD_DB")
+    parser.add_option("--metrics-port", type="int", metavar="PORT",
+        help="serve metrics on PORT instead of settings.METRICS_PORT")
+    options, args = parser.parse_args()
+
+    init_instance(options.instance)
+    if options.metrics_port:
+        settings.METRICS_PORT = options.metrics_port
+
+    if options.quarantine or options.release:
+        retries = init_retries()
+        for username in options.release:
+            if retries.release(username):
+                print "Released %s" % username
+            else:
+                print "%s is not quarantined" % username
+
+        if options.quarantine:
+            for username, dirty, attempts, last_error, updated in retries.quarantined():
+                print "%-20s dirty=%s attempts=%d since=%s\n    %s" % (username, dirty, attempts,
+                    time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(updated)), last_error)
+        sys.exit(0)
+
     log = init_logging()
-    main()
\ No newline at end of file
+    if options.refresh:
+        utils.state.ShadowStore(settings.STATE_DB).clear()
+    main(reconcile_now=options.reconcile)
\ No newline at end of file
@@ -1,4 +1,5 @@
 import os.path
+import signal
 
 try:
     from settings_prod import *
@@ -8,10 +9,93 @@ except ImportError:
 POLL_INTERVAL_SEC = 60
 POLL_ALERT_THRESHOLD = 5
 
+# Timeouts for requests to Stjornbord. Connections are kept open and reused.
+HTTP_CONNECT_TIMEOUT_SEC = 10
+HTTP_READ_TIMEOUT_SEC = 120
+
+# Dirty users are parsed as they arrive and processed in batches of
+# PROCESS_BATCH_SIZE. If DIRTY_USERS_PAGE_SIZE is set the list is fetched
+# from Stjornbord in pages of that many users. The response is read ahead
+# of processing by a background thread, buffering up to
+# DIRTY_USERS_READ_AHEAD users, so it isn't left idle while batches run.
+# With larger backlogs set a page size below that.
+PROCESS_BATCH_SIZE = 100
+DIRTY_USERS_PAGE_SIZE = None
+DIRTY_USERS_READ_AHEAD = 10000
+
+# When RECONCILE_INTERVAL_SEC is set, every that many seconds all users
+# in Stjornbord are compared with the IPA and Google user stores, which are
+# listed in pages of RECONCILE_PAGE_SIZE, and users that have drifted are
+# pushed through the backends. ALL_USERS, a URL listing all users in the
+# same format as the dirty list, must then be set in settings_prod. See
+# also main.py --reconcile, e.g. 24 * 3600 for a daily run.
+RECONCILE_INTERVAL_SEC = None
+RECONCILE_PAGE_SIZE = 500
+
+# Any number of instances, on one host or several, can share the users
+# when SHARD_DB is set to a SQLite database they all reach. On a network
+# filesystem it must support file locks, and the hosts' clocks must be kept
+# in sync (NTP) as lease expiry compares wall clock times. Each instance
+# holds a lease there, renewed every third of SHARD_LEASE_SEC, and
+# processes the users that hash to it on a consistent hash ring of the
+# live instances with SHARD_VNODES points each. An instance that stops
+# renewing drops out and its users move to the others. SHARD_INSTANCE
+# names the instance, the hostname if None. Instances on the same host
+# must each be given a name and a metrics port with main.py --instance and
+# --metrics-port, a named instance keeps its local state in its own
+# STATE_DB. Group sync runs on one of the instances.
+SHARD_DB = None
+SHARD_INSTANCE = None
+SHARD_LEASE_SEC = 30
+SHARD_VNODES = 64
+
+# When GROUP_SYNC is set, the desired group memberships are fetched from
+# Stjornbord every cycle and applied to the IPA and Google groups as
+# minimal additions and removals. GROUPS, a URL returning a JSON object of
+# group name to list of usernames, must then be set in settings_prod.
+# What each group was last synced to is cached, and read again from the
+# backend after GROUP_SNAPSHOT_TTL_SEC.
+GROUP_SYNC = False
+GROUP_SNAPSHOT_TTL_SEC = 3600
+
+# Dirty bits are cleared in bulk at CLEAN_DIRTY_BULK when Stjornbord
+# advertises support for it, with up to CLEAN_DIRTY_BATCH_SIZE users per
+# request. Pending users are sent at least every CLEAN_DIRTY_FLUSH_SEC.
+CLEAN_DIRTY_BATCH_SIZE = 100
+CLEAN_DIRTY_FLUSH_SEC = 5
+
 # How long to sleep when we hit a non-retryable error, for example
 # if a kerberos ticket has expired
 NON_RETRYABLE_ERROR_SLEEP_SEC = 3600
 
+# The Kerberos ticket is checked every KERBEROS_CHECK_INTERVAL_SEC by a
+# background thread, and renewed when it has less than
+# KERBEROS_RENEW_BEFORE_SEC left. If it has expired, processing pauses and
+# the ticket cache is checked again every KERBEROS_RETRY_SEC.
+KERBEROS_CHECK_INTERVAL_SEC = 300
+KERBEROS_RENEW_BEFORE_SEC = 4 * 3600
+KERBEROS_RETRY_SEC = 60
+
+# Local state that survives restarts
+STATE_DB = os.path.join(STATE_ROOT, 'update_daemon.db')
+
+# Backends skip users whose data is identical to what they last applied
+# successfully. Entries older than this are applied again, to correct any
+# drift. Set to 0 to disable. Run with --refresh to start over.
+SHADOW_TTL_SEC = 24 * 3600
+
+# Remember which backends completed a user, so that when a later backend
+# fails the retry resumes where it left off. The journal is keyed on the
+# user's dirty timestamp and discarded when it changes.
+JOURNAL_ENABLED = True
+
+# Users that fail are retried with exponential backoff, starting at
+# RETRY_BASE_DELAY_SEC. After RETRY_MAX_ATTEMPTS failures for the same dirty
+# timestamp they are quarantined, see main.py --quarantine and --release.
+RETRY_BASE_DELAY_SEC = 60
+RETRY_MAX_DELAY_SEC = 6 * 3600
+RETRY_MAX_ATTEMPTS = 8
+
 # User statuses. This should eventually be serialized as a string.
 ACTIVE_USER   = 1
 WCLOSURE_USER = 2
@@ -37,6 +121,89 @@ BACKENDS = [
     'backends.storage.HomeBackend',
 ]
 
+# Number of users pushed through the backend chain concurrently. A value
+# of 1 processes users one at a time. A user is never processed by more
+# than one worker, and always visits the backends in the order above.
+WORKER_COUNT = 1
+
+# Upper bound on workers inside a given backend at the same time. Backends
+# not listed here are only bounded by WORKER_COUNT. The Google client is
+# built on httplib2, which is not thread safe.
+BACKEND_CONCURRENCY = {
+    'backends.google.GoogleBackend': 1,
+}
+
+# Collect IPA password changes and write them in bulk once all users in
+# a batch have been through the backends, instead of one by one.
+IPA_BATCH_PASSWORDS = True
+
+# After writing a password we wait for IPA to register the change before
+# setting the expiry date. Give up after this many seconds, the users stay
+# dirty and are retried.
+IPA_PASSWORD_CONFIRM_TIMEOUT_SEC = 30
+
+# Number of bound connections kept open to the IPA directory server
+IPA_LDAP_POOL_SIZE = 2
+
+# Home directories are created on STORAGE_HOST over a shared SSH control
+# connection. With STORAGE_BATCH_CREATE, all home directories in a batch
+# are created with a single remote invocation.
+STORAGE_HOST = "storage.mr.lan"
+STORAGE_SSH_CONTROL_PATH = os.path.join(STATE_ROOT, 'ssh-%r@%h:%p')
+STORAGE_BATCH_CREATE = True
+STORAGE_SSH_TIMEOUT_SEC = 300
+
+# Home directories of deleted users are archived in the background by
+# ARCHIVE_WORKERS threads, jobs are retried up to ARCHIVE_MAX_ATTEMPTS times
+# after ARCHIVE_RETRY_DELAY_SEC, doubling with each attempt.
+ARCHIVE_WORKERS = 2
+ARCHIVE_MAX_ATTEMPTS = 3
+ARCHIVE_RETRY_DELAY_SEC = 60
+ARCHIVE_TIMEOUT_SEC = 6 * 3600
+
+# External commands (ssh, kinit, klist) run at most SUBPROCESS_MAX_CONCURRENT
+# at a time, and at most SUBPROCESS_LIMITS[name] of a given command.
+SUBPROCESS_MAX_CONCURRENT = 8
+SUBPROCESS_LIMITS = {
+    'ssh': 4,
+    'kinit': 1,
+}
+
+# Google user lookups and updates are grouped into batch requests of up
+# to this many calls. With GOOGLE_BATCH_UPDATES, updates are sent once all
+# users in a batch have been through the backends.
+GOOGLE_BATCH_SIZE = 50
+GOOGLE_BATCH_UPDATES = True
+
+# Prometheus metrics are served on http://METRICS_ADDRESS:METRICS_PORT/metrics,
+# set METRICS_PORT to None to disable.
+METRICS_ADDRESS = "127.0.0.1"
+METRICS_PORT = 9108
+
+# With TRACE_ENABLED each poll cycle that did any work is written to
+# TRACE_ROOT as a Chrome trace (chrome://tracing, ui.perfetto.dev), keeping
+# the TRACE_KEEP most recent.
+TRACE_ENABLED = False
+TRACE_ROOT = LOGGING_ROOT
+TRACE_KEEP = 100
+
+# Sending PROFILE_SIGNAL to the daemon profiles the next PROFILE_CYCLES
+# poll cycles, the stats are written to LOGGING_ROOT.
+PROFILE_SIGNAL = signal.SIGUSR2
+PROFILE_CYCLES = 5
+
+# Record every IPA, Google, Kerberos and SSH call to API_RECORD_FILE, or
+# answer them from such a recording with API_REPLAY_FILE instead of
+# talking to the real services. See apis.recording.
+API_RECORD_FILE = None
+API_REPLAY_FILE = None
+
+
+# Log records are handled by a background thread when LOG_QUEUE is set.
+# Error mails are collected for MAIL_DIGEST_WINDOW_SEC after the first
+# one and sent as a single digest.
+LOG_QUEUE = True
+MAIL_DIGEST_WINDOW_SEC = 300
 
 LOGGING = {
     'version': 1,
@@ -58,11 +225,12 @@ LOGGING = {
         'mail_admins': {
             'level': 'ERROR',
             'filters': ['require_debug_false', ], 
-            'class': 'logging.handlers.SMTPHandler',
+            'class': 'utils.log.DigestSMTPHandler',
             'mailhost': SMTP_HOST,
             'fromaddr': SMTP_FROM,
             'toaddrs':  SMTP_TO,
             'subject':  "Stjornbord update daemon error",
+            'window':   MAIL_DIGEST_WINDOW_SEC,
         },
         'console': {
             'level':'DEBUG',
@@ -95,5 +263,20 @@ LOGGING = {
             'propagate': False,
             'level': 'DEBUG',
         },
+        'kerberosapi': {
+            'handlers': ['mail_admins', 'file_handler', 'console'],
+            'propagate': False,
+            'level': 'DEBUG',
+        },
+        'sshapi': {
+            'handlers': ['mail_admins', 'file_handler', 'console'],
+            'propagate': False,
+            'level': 'DEBUG',
+        },
+        'commandapi': {
+            'handlers': ['mail_admins', 'file_handler', 'console'],
+            'propagate': False,
+            'level': 'DEBUG',
+        },
     }
 }
@@ -6,11 +6,15 @@ DEBUG = True
 # URLs 
 DIRTY_USERS = "http://127.0.0.1:8000/dirty/users/"
 CLEAN_DIRTY = "http://127.0.0.1:8000/clean/user/%s/%s/"
+CLEAN_DIRTY_BULK = "http://127.0.0.1:8000/clean/users/"
+ALL_USERS = "http://127.0.0.1:8000/users/"
+GROUPS = "http://127.0.0.1:8000/groups/"
 
 # Same as in Stjornbord's settings
 SYNC_SECRET = "devsecret123"
 
 LOGGING_ROOT = "/tmp/"
+STATE_ROOT   = "/tmp/"
 # sudo python -m smtpd -n -c DebuggingServer localhost:25
 SMTP_HOST    = "localhost"
 
@@ -20,4 +24,5 @@ GOOGLE_TOKEN   = "/tmp/tokens.dat"
 GOOGLE_SECRETS = os.path.join(os.path.dirname(__file__), "client_secrets.json")
 
 # IPA
-IPA_LDAP_PASS = "secret"
\ No newline at end of file
+IPA_LDAP_PASS = "secret"
+IPA_LDAP_URI  = "ldap://127.0.0.1"
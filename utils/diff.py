@@ -0,0 +1,126 @@
+import hashlib
+import json
+import threading
+
+
+def diff(current, desired):
+    """
+    Returns a dict of the fields in `desired` whose value differs from the
+    one in `current`. Fields missing from `current` count as changed.
+    """
+    changes = {}
+    for field, value in desired.items():
+        if field not in current or current[field] != value:
+            changes[field] = value
+    return changes
+
+
+class WriteStats(object):
+    """
+    Counts writes issued to a backend store versus skipped because the
+    backend already had the desired state.
+    """
+    def __init__(self):
+        self.issued = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    def record(self, changes):
+        """
+        Count a write for `changes`, returns True if it should be issued.
+        """
+        with self.lock:
+            if changes:
+                self.issued += 1
+            else:
+                self.skipped += 1
+        return bool(changes)
+
+    def __str__(self):
+        return "issued=%d skipped=%d" % (self.issued, self.skipped)
+
+
+DIGEST_SIZE = 8
+
+# DigestIndex.check results
+MATCH, DIFFERS, UNKNOWN = "match", "differs", "unknown"
+
+
+def digest(value):
+    """
+    Short digest of a JSON serializable value.
+    """
+    return hashlib.sha1(json.dumps(value, sort_keys=True)).digest()[:DIGEST_SIZE]
+
+
+class DigestIndex(object):
+    """
+    Compact index of username to a digest of the state each of `slots`
+    backends should have for the user, for comparing large user sets
+    without holding them in memory. Per user it keeps a position in a
+    bytearray of digests and flags, no user data.
+    """
+    SKIP = "\0" * DIGEST_SIZE
+
+    REQUIRED = 1
+    SEEN = 2
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.positions = {}
+        self.digests = bytearray()
+        self.flags = bytearray()
+
+    def __len__(self):
+        return len(self.positions)
+
+    def add(self, username, states):
+        """
+        `states` holds for each slot a tuple of the desired state and
+        whether the user must exist in the backend, or None if the backend
+        doesn't matter for the user.
+        """
+        digests = bytearray()
+        flags = bytearray()
+        for state in states:
+            if state is None:
+                digests += self.SKIP
+                flags.append(0)
+            else:
+                digests += digest(state[0])
+                flags.append(state[1] and self.REQUIRED or 0)
+
+        pos = self.positions.get(username)
+        if pos is None:
+            self.positions[username] = len(self.positions)
+            self.digests += digests
+            self.flags += flags
+        else:
+            i = pos * self.slots
+            self.digests[i * DIGEST_SIZE:(i + self.slots) * DIGEST_SIZE] = digests
+            self.flags[i:i + self.slots] = flags
+
+    def check(self, slot, username, state):
+        """
+        Compare the state a backend reported for a user with the desired
+        one, returns MATCH, DIFFERS or UNKNOWN for users not in the index.
+        """
+        pos = self.positions.get(username)
+        if pos is None:
+            return UNKNOWN
+
+        i = pos * self.slots + slot
+        self.flags[i] |= self.SEEN
+        expected = str(self.digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE])
+        if expected == self.SKIP or expected == digest(state):
+            return MATCH
+        return DIFFERS
+
+    def missing(self, slot):
+        """
+        Yield users that must exist in the backend but weren't reported.
+        """
+        for username, pos in self.positions.iteritems():
+            flags = self.flags[pos * self.slots + slot]
+            if flags & self.REQUIRED and not flags & self.SEEN:
+                yield username
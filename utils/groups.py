@@ -0,0 +1,78 @@
+import logging
+import time
+
+log = logging.getLogger("user_daemon.groups")
+
+
+class GroupSync(object):
+    """
+    Keeps group memberships in a backend in line with the desired ones
+    using minimal changes. What each group was last synced to is kept as
+    a snapshot, so a group costs nothing while its desired members stay
+    the same, and when they change only the difference is applied.
+    Snapshots older than `ttl` seconds are read again from the backend to
+    pick up changes made there.
+
+    `fetch(names)` returns a dict of group name to set of members for the
+    groups that exist. `apply(changes)` takes a dict of group name to a
+    tuple of members to add and members to remove, and returns a dict of
+    group name to error for the groups it couldn't fully change.
+    """
+    def __init__(self, name, fetch, apply, ttl=3600):
+        self.name = name
+        self.fetch = fetch
+        self.apply = apply
+        self.ttl = ttl
+
+        # Group name to a tuple of members and when they were last read
+        self.snapshots = {}
+
+    def sync(self, desired):
+        """
+        Sync a dict of group name to set of desired members. Returns a
+        dict of group name to error for the groups that failed.
+        """
+        now = time.time()
+        for name in list(self.snapshots):
+            if name not in desired:
+                del self.snapshots[name]
+
+        expired = [name for name in desired
+            if name not in self.snapshots or now - self.snapshots[name][1] >= self.ttl]
+
+        if expired:
+            fetched = self.fetch(expired)
+            for name in expired:
+                if name in fetched:
+                    self.snapshots[name] = (frozenset(fetched[name]), now)
+                else:
+                    log.error("Group %s does not exist in %s", name, self.name)
+                    self.snapshots.pop(name, None)
+
+        changes = {}
+        for name, members in desired.items():
+            if name not in self.snapshots:
+                continue
+            current = self.snapshots[name][0]
+            add, remove = members - current, current - members
+            if add or remove:
+                changes[name] = (add, remove)
+
+        log.debug("%s: %d groups, %d read, %d changed", self.name, len(desired),
+            len(expired), len(changes))
+        if not changes:
+            return {}
+
+        for name, (add, remove) in sorted(changes.items()):
+            log.info("Group %s in %s: adding %s, removing %s", name, self.name,
+                ", ".join(sorted(add)) or "none", ", ".join(sorted(remove)) or "none")
+
+        errors = self.apply(changes)
+        for name in changes:
+            if name in errors:
+                # Not sure what the group looks like now, read it next time
+                log.error("Could not update group %s in %s: %s", name, self.name, errors[name])
+                self.snapshots.pop(name, None)
+            else:
+                self.snapshots[name] = (frozenset(desired[name]), self.snapshots[name][1])
+        return errors
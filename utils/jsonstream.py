@@ -0,0 +1,65 @@
+import json
+
+WHITESPACE = " \t\n\r"
+
+# Parser states
+START, FIRST, NEXT, VALUE = range(4)
+
+
+def iter_array(fp, chunk_size=16384):
+    """
+    Incrementally parse a top level JSON array from a file like object,
+    yielding each element as soon as it has been read. Only the element
+    currently being parsed is kept in memory.
+    """
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+    state = START
+
+    while True:
+        while pos < len(buf) and buf[pos] in WHITESPACE:
+            pos += 1
+
+        if pos == len(buf):
+            if eof:
+                raise ValueError("Unexpected end of JSON array")
+            data = fp.read(chunk_size)
+            eof = not data
+            buf, pos = data, 0
+            continue
+
+        char = buf[pos]
+        if state == START:
+            if char != "[":
+                raise ValueError("Expected a JSON array, got %r" % char)
+            pos += 1
+            state = FIRST
+
+        elif state in (FIRST, NEXT) and char == "]":
+            return
+
+        elif state == NEXT:
+            if char != ",":
+                raise ValueError("Expected ',' or ']' in JSON array, got %r" % char)
+            pos += 1
+            state = VALUE
+
+        else:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                end = None
+
+            # Either the element is incomplete, or it runs up to the end of
+            # the buffer and may continue in the next chunk (e.g. numbers).
+            if end is None or (end == len(buf) and not eof):
+                data = fp.read(chunk_size)
+                eof = not data
+                buf, pos = buf[pos:] + data, 0
+                continue
+
+            yield value
+            pos = end
+            state = NEXT
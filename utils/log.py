@@ -0,0 +1,215 @@
+"""
+Logging that stays off the processing threads: records are handed to a
+background thread through a queue, and error mails are sent as periodic
+digests instead of one mail per record.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import Queue
+import smtplib
+import sys
+import threading
+import time
+import traceback
+from email.utils import formatdate
+
+
+class QueueHandler(logging.Handler):
+    """
+    Puts records on a queue for a QueueListener to pass on to `targets`.
+    Never blocks, records are dropped if the queue is full.
+    """
+    def __init__(self, listener, targets):
+        logging.Handler.__init__(self)
+        self.listener = listener
+        self.targets = list(targets)
+
+    def prepare(self, record):
+        # Render the message and traceback now, the arguments may have
+        # changed by the time the record is handled.
+        record.template = record.msg
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = "".join(traceback.format_exception(*record.exc_info)).rstrip("\n")
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.listener.put(self.prepare(record), self.targets)
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    def __init__(self, maxsize=10000):
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+        self.thread = None
+
+    def put(self, record, targets):
+        try:
+            self.queue.put_nowait((record, targets))
+        except Queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="log-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Handle what's queued and stop the thread.
+        """
+        if self.thread is not None:
+            self.queue.put((None, None))
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while True:
+            record, targets = self.queue.get()
+            if record is None:
+                return
+
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                sys.stderr.write("Log queue full, dropped %d records\n" % dropped)
+
+            for handler in targets:
+                if record.levelno >= handler.level:
+                    try:
+                        handler.handle(record)
+                    except Exception:
+                        handler.handleError(record)
+
+
+def install_queue(logger_names, maxsize=10000):
+    """
+    Move the handlers of the named loggers behind a single queue, drained
+    by a background thread. Queued records are handled at exit.
+    """
+    listener = QueueListener(maxsize)
+    for name in logger_names:
+        logger = logging.getLogger(name)
+        if logger.handlers:
+            logger.handlers = [QueueHandler(listener, logger.handlers)]
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def _unicode(value):
+    if isinstance(value, unicode):
+        return value
+    if not isinstance(value, str):
+        value = str(value)
+    return value.decode("utf-8", "replace")
+
+
+class DigestSMTPHandler(logging.handlers.SMTPHandler):
+    """
+    Collects records for `window` seconds after the first one and mails
+    them as one digest, grouped by logger and message template with a
+    count and the first occurrence in full for each group.
+    """
+    def __init__(self, mailhost, fromaddr, toaddrs, subject, credentials=None,
+            secure=None, window=300, timeout=30):
+        logging.handlers.SMTPHandler.__init__(self, mailhost, fromaddr, toaddrs, subject,
+            credentials, secure)
+        self.window = window
+        self.smtp_timeout = timeout
+        self.pending = {}
+        self.order = []
+        self.first = None
+
+        t = threading.Thread(target=self._run, name="mail-digest")
+        t.daemon = True
+        t.start()
+
+    def emit(self, record):
+        key = (record.name, getattr(record, "template", record.msg))
+        try:
+            text = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        self.acquire()
+        try:
+            if key not in self.pending:
+                self.pending[key] = [0, text, record.created, record]
+                self.order.append(key)
+            entry = self.pending[key]
+            entry[0] += 1
+            entry[2] = record.created
+            if self.first is None:
+                self.first = time.time()
+        finally:
+            self.release()
+
+    def _run(self):
+        while True:
+            time.sleep(min(self.window, 10))
+            if self.first is not None and time.time() - self.first >= self.window:
+                try:
+                    self.send_digest()
+                except Exception:
+                    # Keep the thread alive for the next digest
+                    traceback.print_exc(file=sys.stderr)
+
+    def send_digest(self):
+        self.acquire()
+        try:
+            entries = [self.pending[key] for key in self.order]
+            self.pending, self.order, self.first = {}, [], None
+        finally:
+            self.release()
+
+        if not entries:
+            return
+
+        total = sum(entry[0] for entry in entries)
+        subject = "%s: %d error%s" % (self.subject, total, total != 1 and "s" or "")
+        if len(entries) > 1:
+            subject += " (%d kinds)" % len(entries)
+
+        summary = []
+        details = []
+        for count, text, last, record in entries:
+            template = _unicode(getattr(record, "template", record.msg))
+            text = _unicode(text)
+            summary.append("%6dx  %s" % (count, template.splitlines()[0]))
+            details.append("%dx, first at %s, last at %s\n%s" % (count,
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.created)),
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(last)), text))
+
+        body = u"\n".join(summary) + u"\n\n" + u"\n\n".join(details)
+        try:
+            self._send(subject, body)
+        except Exception:
+            self.handleError(entries[0][3])
+
+    def _send(self, subject, body):
+        smtp = smtplib.SMTP(self.mailhost, self.mailport or smtplib.SMTP_PORT,
+            timeout=self.smtp_timeout)
+        msg = ("From: %s\r\nTo: %s\r\nSubject: %s\r\nDate: %s\r\n"
+            "Content-Type: text/plain; charset=utf-8\r\n\r\n%s") % (
+            self.fromaddr, ",".join(self.toaddrs), subject, formatdate(), body)
+        if isinstance(msg, unicode):
+            msg = msg.encode("utf-8")
+        if self.username:
+            if self.secure is not None:
+                smtp.ehlo()
+                smtp.starttls(*self.secure)
+                smtp.ehlo()
+            smtp.login(self.username, self.password)
+        smtp.sendmail(self.fromaddr, self.toaddrs, msg)
+        smtp.quit()
+
+    def close(self):
+        self.send_digest()
+        logging.handlers.SMTPHandler.close(self)
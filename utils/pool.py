@@ -0,0 +1,150 @@
+import logging
+import sys
+import threading
+import Queue
+import time
+
+log = logging.getLogger("user_daemon.pool")
+
+
+class WorkerPool(object):
+    """
+    A fixed number of daemon threads consuming jobs from a shared queue.
+    Jobs are plain callables, they are expected to handle their own errors.
+    """
+    def __init__(self, size, name="worker"):
+        self.size = size
+        self.queue = Queue.Queue()
+        self.threads = []
+
+        for i in range(size):
+            t = threading.Thread(target=self._run, name="%s-%d" % (name, i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _run(self):
+        while True:
+            func, args = self.queue.get()
+            try:
+                func(*args)
+            except Exception:
+                log.exception("Uncaught exception in worker job %s", func)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, func, *args):
+        self.queue.put((func, args))
+
+    def join(self):
+        """
+        Block until every submitted job has finished.
+        """
+        self.queue.join()
+
+
+class JobRunner(object):
+    """
+    Runs jobs from a persistent utils.state.JobQueue on `size` daemon
+    threads. `handler(job_id, username)` does the work and raises on
+    failure, failed jobs are retried up to `max_attempts` times after a
+    delay starting at `retry_delay` seconds and doubling each time.
+    """
+    def __init__(self, jobs, kind, handler, size=1, max_attempts=3, idle_sec=30, retry_delay=60):
+        self.jobs = jobs
+        self.kind = kind
+        self.handler = handler
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.idle_sec = idle_sec
+        self.wakeup = threading.Event()
+
+        for i in range(size):
+            t = threading.Thread(target=self._run, name="%s-%d" % (kind, i))
+            t.daemon = True
+            t.start()
+
+    def submit(self, username, dirty=None):
+        """
+        Returns once the job has been durably queued, see JobQueue.enqueue.
+        """
+        self.jobs.enqueue(self.kind, username, dirty)
+        self.wakeup.set()
+
+    def _run(self):
+        while True:
+            try:
+                job = self.jobs.claim(self.kind)
+            except Exception:
+                log.exception("Could not claim %s job", self.kind)
+                job = None
+
+            if job is None:
+                self.wakeup.wait(self.idle_sec)
+                self.wakeup.clear()
+                continue
+
+            job_id, username, attempts = job
+            log.info("Running %s job for %s (attempt %d)", self.kind, username, attempts)
+            start = time.time()
+            try:
+                self.handler(job_id, username)
+            except Exception, e:
+                retry = attempts < self.max_attempts
+                log.log(retry and logging.WARNING or logging.ERROR,
+                    "%s job for %s failed (attempt %d of %d): %s",
+                    self.kind, username, attempts, self.max_attempts, e, exc_info=True)
+                self.jobs.finish(job_id, "%s: %s" % (e.__class__.__name__, e), retry=retry,
+                    delay=self.retry_delay * 2 ** (attempts - 1))
+            else:
+                log.info("%s job for %s done in %.1f seconds", self.kind, username, time.time() - start)
+                self.jobs.finish(job_id)
+
+
+def read_ahead(iterable, size):
+    """
+    Consume `iterable` on a background thread, buffering up to `size`
+    items, and yield them. An exception raised by the iterable is raised
+    here after the items before it. If the caller stops early the thread
+    stops too, and closes the iterable if it's a generator.
+    """
+    queue = Queue.Queue(size)
+    stopped = threading.Event()
+
+    def _put(entry):
+        while not stopped.is_set():
+            try:
+                queue.put(entry, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _run():
+        try:
+            for item in iterable:
+                if not _put((True, item)):
+                    break
+            else:
+                _put((False, None))
+        except Exception:
+            _put((False, sys.exc_info()))
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    t = threading.Thread(target=_run, name="read-ahead")
+    t.daemon = True
+    t.start()
+
+    try:
+        while True:
+            more, item = queue.get()
+            if more:
+                yield item
+            elif item is not None:
+                raise item[0], item[1], item[2]
+            else:
+                return
+    finally:
+        stopped.set()
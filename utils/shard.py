@@ -0,0 +1,142 @@
+"""
+Sharding of users across daemon instances. The live instances, those
+holding a lease in a shared utils.state.LeaseStore, are placed on a
+consistent hash ring and each processes the users that hash to it. When
+an instance joins or its lease lapses only its share of the users moves.
+
+While the ring changes two instances may briefly both think they own a
+user, so users are also claimed for the duration of a batch. A user is
+only processed by the instance holding its claim.
+"""
+
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+
+import utils.state
+
+log = logging.getLogger("user_daemon.shard")
+
+
+def _hash(key):
+    if isinstance(key, unicode):
+        key = key.encode("utf8")
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hash ring with `vnodes` points per member.
+    """
+    def __init__(self, members, vnodes=64):
+        self.members = sorted(members)
+        points = sorted((_hash("%s#%d" % (member, i)), member)
+            for member in self.members for i in range(vnodes))
+        self.keys = [key for key, member in points]
+        self.owners = [member for key, member in points]
+
+    def owner(self, key):
+        if not self.keys:
+            return None
+        return self.owners[bisect.bisect(self.keys, _hash(key)) % len(self.keys)]
+
+
+class Shard(object):
+    """
+    This instance's share of the users. The lease is renewed every third
+    of `ttl` by a background thread, refresh() rebuilds the ring from the
+    live instances and should be called every cycle, it returns True when
+    the ring changed. Only one process at a time can run as a given
+    instance.
+    """
+    def __init__(self, path, instance, ttl=30, vnodes=64):
+        self.store = utils.state.LeaseStore(path)
+        self.instance = instance
+        self.holder = "%s-%d" % (socket.gethostname(), os.getpid())
+        self.ttl = ttl
+        self.vnodes = vnodes
+        self.ring = HashRing([instance], vnodes)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        # A previous run of the instance that didn't stop cleanly holds
+        # the lease until it expires.
+        deadline = time.time() + self.ttl
+        while True:
+            try:
+                self.store.renew(self.instance, self.holder, self.ttl)
+                break
+            except utils.state.LeaseHeld, e:
+                if time.time() >= deadline:
+                    raise
+                log.warning("%s, waiting for the lease to expire", e)
+                time.sleep(1)
+        self.refresh()
+
+        self.thread = threading.Thread(target=self._run, name="shard-lease")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Give up the lease and claims, the other instances take over once
+        they next refresh.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.store.drop(self.instance, self.holder)
+        log.info("Released shard lease of %s", self.instance)
+
+    def _run(self):
+        while True:
+            self.stopped.wait(self.ttl / 3.0)
+            if self.stopped.is_set():
+                return
+            try:
+                if not self.store.renew(self.instance, self.holder, self.ttl):
+                    log.error("Shard lease of %s had expired, rejoined", self.instance)
+            except Exception:
+                log.exception("Could not renew shard lease of %s", self.instance)
+
+    def refresh(self):
+        # Raises LeaseHeld if another process has taken over the instance
+        if not self.store.renew(self.instance, self.holder, self.ttl):
+            # Not renewed in time, our claims are gone and others may
+            # have taken over our users
+            log.warning("Shard lease of %s had expired, rejoined", self.instance)
+        members = self.store.live()
+
+        if members != self.ring.members:
+            log.info("Shard members changed from %s to %s, rebalancing",
+                ", ".join(self.ring.members), ", ".join(members))
+            self.ring = HashRing(members, self.vnodes)
+            return True
+        return False
+
+    def owns(self, username):
+        return self.ring.owner(username) == self.instance
+
+    def is_leader(self):
+        """
+        True for one of the live instances, for work that should only be
+        done once.
+        """
+        return self.ring.members[:1] == [self.instance]
+
+    def claim(self, usernames):
+        """
+        Claim the users this instance owns and no other instance holds.
+        Returns the set of usernames claimed, to be released when done.
+        """
+        owned = [username for username in usernames if self.owns(username)]
+        return self.store.claim(self.instance, owned, self.ttl)
+
+    def release(self, usernames):
+        self.store.release(self.instance, usernames)
@@ -0,0 +1,491 @@
+import contextlib
+import logging
+import random
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger("user_daemon.state")
+
+
+class LeaseHeld(Exception): pass
+
+
+class StateStore(object):
+    """
+    Small SQLite database for state that has to survive restarts. Each
+    thread gets its own connection, statements are autocommitted unless
+    run inside transaction().
+    """
+    SCHEMA = []
+
+    # Columns added to existing tables, as (table, column definition)
+    COLUMNS = []
+
+    # Losing the last few writes on power failure is acceptable, an fsync
+    # per write is not.
+    JOURNAL_MODE = "WAL"
+    SYNCHRONOUS = "NORMAL"
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+        for statement in self.SCHEMA:
+            self.execute(statement)
+
+        for table, column in self.COLUMNS:
+            existing = [row[1] for row in self.execute("PRAGMA table_info(%s)" % table)]
+            if column.split()[0] not in existing:
+                self.execute("ALTER TABLE %s ADD COLUMN %s" % (table, column))
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=%s" % self.JOURNAL_MODE)
+            conn.execute("PRAGMA synchronous=%s" % self.SYNCHRONOUS)
+            self.local.conn = conn
+        return conn
+
+    def execute(self, sql, params=()):
+        return self._conn().execute(sql, params)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Run statements in a write transaction, rolled back on exceptions.
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def executemany(self, sql, params):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(sql, params)
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+class ShadowStore(StateStore):
+    """
+    Records, per backend and user, a fingerprint of the last user data
+    that was successfully applied.
+    """
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS shadow ("
+        "  backend TEXT NOT NULL,"
+        "  username TEXT NOT NULL,"
+        "  fingerprint TEXT NOT NULL,"
+        "  applied REAL NOT NULL,"
+        "  PRIMARY KEY (backend, username))",
+    ]
+
+    def matches(self, backend, username, fingerprint, max_age):
+        """
+        True if `fingerprint` was applied for the user less than `max_age`
+        seconds ago.
+        """
+        row = self.execute("SELECT fingerprint, applied FROM shadow "
+            "WHERE backend = ? AND username = ?", (backend, username)).fetchone()
+        return (row is not None and row[0] == fingerprint and
+            time.time() - row[1] < max_age)
+
+    def record(self, backend, fingerprints):
+        """
+        Store a list of (username, fingerprint) tuples as applied now.
+        """
+        now = time.time()
+        self.executemany("INSERT OR REPLACE INTO shadow (backend, username, fingerprint, applied) "
+            "VALUES (?, ?, ?, ?)", [(backend, u, f, now) for u, f in fingerprints])
+
+    def forget(self, usernames):
+        """
+        Forget what was applied for the users, in all backends.
+        """
+        self.executemany("DELETE FROM shadow WHERE username = ?",
+            [(username, ) for username in usernames])
+
+    def usernames(self):
+        return [row[0] for row in self.execute("SELECT DISTINCT username FROM shadow")]
+
+    def clear(self):
+        log.info("Clearing shadow state")
+        self.execute("DELETE FROM shadow")
+
+
+class Journal(StateStore):
+    """
+    Records which backends have completed a user's current dirty state, so
+    that a retry can resume at the first backend that didn't. Entries for
+    an older dirty timestamp are discarded when looked up.
+    """
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS journal ("
+        "  username TEXT NOT NULL,"
+        "  backend TEXT NOT NULL,"
+        "  dirty TEXT NOT NULL,"
+        "  PRIMARY KEY (username, backend))",
+    ]
+
+    def completed(self, username, dirty):
+        """
+        Returns the set of backends that completed the user at `dirty`.
+        """
+        rows = self.execute("SELECT backend, dirty FROM journal WHERE username = ?",
+            (username, )).fetchall()
+
+        if any(row[1] != unicode(dirty) for row in rows):
+            log.info("Dirty timestamp changed for %s, discarding journal", username)
+            self.forget([username])
+            return set()
+        return set(row[0] for row in rows)
+
+    def complete(self, entries):
+        """
+        Store a list of (username, backend, dirty) tuples as completed.
+        """
+        self.executemany("INSERT OR REPLACE INTO journal (username, backend, dirty) VALUES (?, ?, ?)",
+            [(username, backend, unicode(dirty)) for username, backend, dirty in entries])
+
+    def forget(self, usernames):
+        self.executemany("DELETE FROM journal WHERE username = ?",
+            [(username, ) for username in usernames])
+
+    def usernames(self):
+        return [row[0] for row in self.execute("SELECT DISTINCT username FROM journal")]
+
+
+class RetrySchedule(StateStore):
+    """
+    Tracks users that failed processing, and when they may be attempted
+    again. The delay doubles with each failure, with jitter, and after
+    `max_attempts` failures the user is quarantined until released. A new
+    dirty timestamp from Stjornbord starts over, as the data has changed.
+    """
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS retries ("
+        "  username TEXT PRIMARY KEY,"
+        "  dirty TEXT NOT NULL,"
+        "  attempts INTEGER NOT NULL,"
+        "  next_attempt REAL NOT NULL,"
+        "  quarantined INTEGER NOT NULL,"
+        "  last_error TEXT,"
+        "  updated REAL NOT NULL)",
+    ]
+
+    # SQLite limits the number of parameters in a statement
+    CHUNK_SIZE = 500
+
+    def __init__(self, path, base_delay, max_delay, max_attempts):
+        StateStore.__init__(self, path)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+
+    def filter_due(self, users):
+        """
+        Returns the users that may be attempted now.
+        """
+        now = time.time()
+        rows = {}
+        for i in range(0, len(users), self.CHUNK_SIZE):
+            chunk = [user["username"] for user in users[i:i + self.CHUNK_SIZE]]
+            for row in self.execute("SELECT username, dirty, next_attempt, quarantined FROM retries "
+                    "WHERE username IN (%s)" % ",".join("?" * len(chunk)), chunk):
+                rows[row[0]] = row[1:]
+
+        due = []
+        for user in users:
+            row = rows.get(user["username"])
+            if row is None or row[0] != unicode(user["dirty"]):
+                due.append(user)
+            elif row[2]:
+                log.debug("User %s is quarantined, skipping", user["username"])
+            elif row[1] <= now:
+                due.append(user)
+            else:
+                log.debug("User %s is backing off for another %d seconds", user["username"], row[1] - now)
+        return due
+
+    def failed(self, user, error):
+        """
+        Record a failed attempt, returns True if the user got quarantined.
+        """
+        row = self.execute("SELECT dirty, attempts FROM retries WHERE username = ?",
+            (user["username"], )).fetchone()
+
+        attempts = 1
+        if row is not None and row[0] == unicode(user["dirty"]):
+            attempts = row[1] + 1
+
+        delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+        delay *= random.uniform(0.5, 1.0)
+        quarantined = attempts >= self.max_attempts
+
+        now = time.time()
+        self.execute("INSERT OR REPLACE INTO retries (username, dirty, attempts, next_attempt, "
+            "quarantined, last_error, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user["username"], unicode(user["dirty"]), attempts, now + delay,
+             int(quarantined), unicode(error), now))
+
+        if quarantined:
+            log.error("User %s failed %d times and has been quarantined. Last error: %s",
+                user["username"], attempts, error)
+        else:
+            log.info("User %s failed %d times, next attempt in %d seconds",
+                user["username"], attempts, delay)
+        return quarantined
+
+    def succeeded(self, usernames):
+        self.executemany("DELETE FROM retries WHERE username = ?",
+            [(username, ) for username in usernames])
+
+    def quarantined(self):
+        """
+        Returns a list of (username, dirty, attempts, last_error, updated)
+        for quarantined users.
+        """
+        return self.execute("SELECT username, dirty, attempts, last_error, updated "
+            "FROM retries WHERE quarantined = 1 ORDER BY username").fetchall()
+
+    def release(self, username):
+        """
+        Release a user from quarantine, returns False if it wasn't there.
+        """
+        return self.execute("DELETE FROM retries WHERE username = ? AND quarantined = 1",
+            (username, )).rowcount > 0
+
+
+class JobQueue(StateStore):
+    """
+    A persistent queue of background jobs, one per kind and username, for
+    the user's dirty timestamp when queued. Jobs move from queued to
+    running to done, or back to queued after a delay on failure until
+    they run out of attempts and are marked failed.
+    """
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        "  id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        "  kind TEXT NOT NULL,"
+        "  username TEXT NOT NULL,"
+        "  status TEXT NOT NULL,"
+        "  attempts INTEGER NOT NULL DEFAULT 0,"
+        "  progress TEXT,"
+        "  error TEXT,"
+        "  created REAL NOT NULL,"
+        "  updated REAL NOT NULL,"
+        "  UNIQUE (kind, username))",
+    ]
+
+    COLUMNS = [
+        ("jobs", "owner TEXT"),
+        ("jobs", "dirty TEXT"),
+        ("jobs", "not_before REAL NOT NULL DEFAULT 0"),
+        ("jobs", "rerun INTEGER NOT NULL DEFAULT 0"),
+    ]
+
+    # A queued job is all that is left of the work once the dirty bit is
+    # cleared, so it has to be on disk before enqueue returns.
+    SYNCHRONOUS = "FULL"
+
+    def __init__(self, path, owner=None):
+        """
+        Jobs are claimed in the name of `owner`, so that instances sharing
+        the database only run again the jobs that they left running.
+        """
+        StateStore.__init__(self, path)
+        self.owner = owner
+
+        # Jobs that were running when the daemon stopped are run again
+        if owner is None:
+            self.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+        else:
+            self.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running' "
+                "AND (owner = ? OR owner IS NULL)", (owner, ))
+
+    def enqueue(self, kind, username, dirty=None):
+        """
+        Durably queue a job, unless one is already queued, running or done
+        for the same `dirty` timestamp. Failed jobs are queued again, as
+        are done jobs when the user has changed since, e.g. a username
+        that is deleted again after being reused.
+        """
+        now = time.time()
+        dirty = dirty is not None and unicode(dirty) or None
+        self.execute("INSERT OR IGNORE INTO jobs (kind, username, status, dirty, created, updated) "
+            "VALUES (?, ?, 'queued', ?, ?, ?)", (kind, username, dirty, now, now))
+        self.execute("UPDATE jobs SET status = 'queued', attempts = 0, dirty = ?, not_before = 0, "
+            "progress = NULL, error = NULL, updated = ? WHERE kind = ? AND username = ? AND "
+            "(status = 'failed' OR (status IN ('done', 'queued') AND dirty IS NOT ?))",
+            (dirty, now, kind, username, dirty))
+        # A running job is for the old timestamp, run it again when it's done
+        self.execute("UPDATE jobs SET dirty = ?, rerun = 1, updated = ? WHERE kind = ? AND "
+            "username = ? AND status = 'running' AND dirty IS NOT ?", (dirty, now, kind, username, dirty))
+
+    def claim(self, kind):
+        """
+        Mark the oldest queued job of `kind` as running, returns a tuple of
+        (id, username, attempts) or None.
+        """
+        with self.transaction() as conn:
+            row = conn.execute("SELECT id, username, attempts FROM jobs WHERE kind = ? "
+                "AND status = 'queued' AND not_before <= ? ORDER BY id LIMIT 1",
+                (kind, time.time())).fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, "
+                    "owner = ?, updated = ? WHERE id = ?", (self.owner, time.time(), row[0]))
+
+        if row is None:
+            return None
+        return row[0], row[1], row[2] + 1
+
+    def progress(self, job_id, progress):
+        self.execute("UPDATE jobs SET progress = ?, updated = ? WHERE id = ?",
+            (progress, time.time(), job_id))
+
+    def finish(self, job_id, error=None, retry=False, delay=0):
+        """
+        Mark a job done, or failed with `error`. A failed job to be retried
+        is queued again, to be claimed no sooner than `delay` seconds from
+        now.
+        """
+        if error is None:
+            status = "done"
+        elif retry:
+            status = "queued"
+        else:
+            status = "failed"
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute("UPDATE jobs SET status = ?, error = ?, not_before = ?, updated = ? "
+                "WHERE id = ?", (status, error, now + delay, now, job_id))
+            conn.execute("UPDATE jobs SET status = 'queued', attempts = 0, not_before = 0, rerun = 0 "
+                "WHERE id = ? AND rerun = 1", (job_id, ))
+
+    def status(self, kind, username, dirty=None):
+        """
+        Returns the job's status, or None if there is no such job. If
+        `dirty` is given, only a job queued for that timestamp counts.
+        """
+        row = self.execute("SELECT status, dirty FROM jobs WHERE kind = ? AND username = ?",
+            (kind, username)).fetchone()
+        if row is None or (dirty is not None and row[1] != unicode(dirty)):
+            return None
+        return row[0]
+
+    def counts(self, kind):
+        return dict(self.execute("SELECT status, COUNT(*) FROM jobs WHERE kind = ? "
+            "GROUP BY status", (kind, )).fetchall())
+
+
+class LeaseStore(StateStore):
+    """
+    Coordinates daemon instances sharing the database. Each live instance
+    holds a lease it keeps renewing, and claims the users it is about to
+    process. Claims are renewed with the lease and lapse with it, so the
+    users of an instance that dies are free once its lease expires.
+
+    Expiry times are compared across hosts, so their clocks must be kept
+    in sync. WAL needs shared memory between the processes and doesn't
+    work on network filesystems, the rollback journal does.
+    """
+    JOURNAL_MODE = "DELETE"
+    SYNCHRONOUS = "FULL"
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS leases ("
+        "  instance TEXT PRIMARY KEY,"
+        "  holder TEXT NOT NULL,"
+        "  started REAL NOT NULL,"
+        "  expires REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS claims ("
+        "  username TEXT PRIMARY KEY,"
+        "  instance TEXT NOT NULL,"
+        "  expires REAL NOT NULL)",
+    ]
+
+    CHUNK_SIZE = 500
+
+    def renew(self, instance, holder, ttl):
+        """
+        Take or extend the instance's lease and claims for `ttl` seconds on
+        behalf of `holder`, the process running the instance. Returns False
+        if the lease had expired, in which case the claims are dropped as
+        others may have taken over. Raises LeaseHeld if another process
+        holds the instance's lease.
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute("SELECT holder, expires FROM leases WHERE instance = ?",
+                (instance, )).fetchone()
+            if row is not None and row[1] > now and row[0] != holder:
+                raise LeaseHeld("Instance %s is held by %s" % (instance, row[0]))
+
+            if row is None or row[1] <= now:
+                conn.execute("INSERT OR REPLACE INTO leases (instance, holder, started, expires) "
+                    "VALUES (?, ?, ?, ?)", (instance, holder, now, now + ttl))
+                conn.execute("DELETE FROM claims WHERE instance = ?", (instance, ))
+            else:
+                conn.execute("UPDATE leases SET expires = ? WHERE instance = ?",
+                    (now + ttl, instance))
+                conn.execute("UPDATE claims SET expires = ? WHERE instance = ?",
+                    (now + ttl, instance))
+        return row is None or row[1] > now
+
+    def live(self):
+        """
+        Returns the names of the instances holding a lease, expired leases
+        and claims are removed.
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM leases WHERE expires <= ?", (now, ))
+            conn.execute("DELETE FROM claims WHERE expires <= ?", (now, ))
+            return [row[0] for row in conn.execute("SELECT instance FROM leases ORDER BY instance")]
+
+    def claim(self, instance, usernames, ttl):
+        """
+        Claim the users for the instance, unless another instance holds an
+        unexpired claim. Returns the set of usernames claimed.
+        """
+        now = time.time()
+        usernames = list(usernames)
+        claimed = set()
+        with self.transaction() as conn:
+            for i in range(0, len(usernames), self.CHUNK_SIZE):
+                chunk = usernames[i:i + self.CHUNK_SIZE]
+                taken = set(row[0] for row in conn.execute("SELECT username FROM claims "
+                    "WHERE username IN (%s) AND instance != ? AND expires > ?" % ",".join("?" * len(chunk)),
+                    chunk + [instance, now]))
+                free = [username for username in chunk if username not in taken]
+                conn.executemany("INSERT OR REPLACE INTO claims (username, instance, expires) "
+                    "VALUES (?, ?, ?)", [(username, instance, now + ttl) for username in free])
+                claimed.update(free)
+        return claimed
+
+    def release(self, instance, usernames):
+        """
+        Release the instance's claims on the users.
+        """
+        self.executemany("DELETE FROM claims WHERE username = ? AND instance = ?",
+            [(username, instance) for username in usernames])
+
+    def drop(self, instance, holder):
+        """
+        Give up the instance's lease and all its claims, unless another
+        process has taken the instance over.
+        """
+        with self.transaction() as conn:
+            if conn.execute("DELETE FROM leases WHERE instance = ? AND holder = ?",
+                    (instance, holder)).rowcount:
+                conn.execute("DELETE FROM claims WHERE instance = ?", (instance, ))
@@ -0,0 +1,156 @@
+"""
+Opt-in per-cycle tracing and on-demand profiling.
+
+Spans are recorded as Chrome trace events, one file per poll cycle, which
+can be opened in chrome://tracing or https://ui.perfetto.dev.
+"""
+
+import contextlib
+import cProfile
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger("user_daemon.tracing")
+
+
+class Tracer(object):
+    """
+    Collects spans while a cycle is open and writes them to
+    `directory`/trace-<timestamp>.json when it ends, keeping the `keep`
+    most recent files.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self.keep = 0
+        self.events = None
+        self.threads = set()
+        self.lock = threading.Lock()
+
+    def configure(self, directory, keep=50):
+        self.directory = directory
+        self.keep = keep
+        self.enabled = True
+
+    def begin_cycle(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.events = []
+            self.threads = set()
+
+    def end_cycle(self, discard=False):
+        """
+        Write the cycle's spans, returns the file name or None if there
+        was nothing to write.
+        """
+        with self.lock:
+            events, self.events = self.events, None
+        if not events or discard:
+            return None
+
+        now = time.time()
+        filename = os.path.join(self.directory, "trace-%s-%03d.json" % (
+            time.strftime("%Y%m%d-%H%M%S", time.localtime(now)), int(now * 1000) % 1000))
+        with open(filename, "w") as fp:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fp)
+        log.debug("Wrote %d trace events to %s", len(events), filename)
+
+        self._rotate()
+        return filename
+
+    def _rotate(self):
+        if not self.keep:
+            return
+        for filename in sorted(glob.glob(os.path.join(self.directory, "trace-*.json")))[:-self.keep]:
+            try:
+                os.remove(filename)
+            except OSError, e:
+                log.warning("Could not remove old trace %s: %s", filename, e)
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        """
+        Record the enclosed block as a span, a no-op unless a cycle is open.
+        """
+        if self.events is None:
+            yield
+            return
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            thread = threading.current_thread()
+            event = {
+                "name": name, "cat": category, "ph": "X",
+                "ts": int(start * 1e6), "dur": int((end - start) * 1e6),
+                "pid": os.getpid(), "tid": thread.ident,
+            }
+            if args:
+                event["args"] = args
+
+            with self.lock:
+                if self.events is not None:
+                    if thread.ident not in self.threads:
+                        self.threads.add(thread.ident)
+                        self.events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(),
+                            "tid": thread.ident, "args": {"name": thread.name}})
+                    self.events.append(event)
+
+
+class CycleProfiler(object):
+    """
+    Profiles the next `cycles` poll cycles with cProfile once toggled,
+    typically from a signal handler, and dumps the stats to `directory`.
+    Toggling again while profiling stops early. Only the main thread is
+    profiled, so set settings.WORKER_COUNT to 1 to see backend work.
+    """
+    def __init__(self, directory, cycles):
+        self.directory = directory
+        self.cycles = cycles
+        self.requested = False
+        self.profile = None
+        self.remaining = 0
+
+    def toggle(self, *args):
+        # Only sets a flag, it's safe to call from a signal handler
+        self.requested = True
+
+    def begin_cycle(self):
+        if not self.requested:
+            return
+        self.requested = False
+
+        if self.profile is not None:
+            self._dump()
+            return
+
+        log.info("Profiling the next %d cycles", self.cycles)
+        self.profile = cProfile.Profile()
+        self.remaining = self.cycles
+        self.profile.enable()
+
+    def end_cycle(self):
+        if self.profile is None:
+            return
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self._dump()
+
+    def _dump(self):
+        self.profile.disable()
+        filename = os.path.join(self.directory, "profile-%s.pstats" %
+            time.strftime("%Y%m%d-%H%M%S"))
+        self.profile.dump_stats(filename)
+        self.profile = None
+        log.info("Wrote profile to %s", filename)
+
+
+tracer = Tracer()
+span = tracer.span